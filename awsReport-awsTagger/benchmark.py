@@ -0,0 +1,422 @@
+__author__ = 'Yevgeniy Ovsyannikov'
+
+import os
+import gc
+import csv
+import json
+import time
+import click
+import boto3
+import shutil
+import logging
+import datetime
+import tempfile
+import threading
+import tracemalloc
+import collections
+from botocore.awsrequest import AWSResponse
+from kubernetes import client
+
+import main
+
+# Common
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_FLOWS = 'report,update_tags,kube-report'
+DEFAULT_REGIONS = 4
+DEFAULT_SKUS = 50
+PAGE_SIZE = 1000  # instances in one describe_instances page, like AWS returns without MaxResults
+PRICE_PAGE_SIZE = 100  # products in one get_products page
+PODS_PER_SERVICE = 5
+CONTAINERS_PER_POD = 2
+ACCOUNT_ID = '000000000000'
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-west-2', 'eu-west-3',
+           'eu-central-1', 'eu-north-1', 'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-southeast-1',
+           'ap-southeast-2', 'ca-central-1', 'sa-east-1']
+DEPARTMENTS = ['devops', 'backend', 'frontend', 'data']
+VOLUME_TYPES = ['gp2', 'gp3', 'io1', 'st1', 'sc1', 'standard']
+LAUNCH_TIME = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+# Logs of flows would be measured too, so only benchmark logs are shown when it runs
+logger = logging.getLogger('benchmark')
+
+
+# Class for synthetic AWS account, answers AWS calls before they are sent, so nothing leaves the machine
+class SyntheticAccount(object):
+
+    def __init__(self, instances, regions=DEFAULT_REGIONS, volumes=1, skus=DEFAULT_SKUS):
+        self.instances = instances
+        self.regions = REGIONS[:max(1, min(regions, len(REGIONS)))]
+        self.volumes = volumes
+        self.instance_types = ['m{0}.size{1}'.format(5 + i // 10, i % 10) for i in range(skus)]
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    # Instances are spread over regions evenly
+    def region_size(self, region):
+        number = self.regions.index(region)
+        return self.instances // len(self.regions) + (1 if number < self.instances % len(self.regions) else 0)
+
+    @staticmethod
+    def instance_id(region, number):
+        return 'i-{0}-{1:08d}'.format(region, number)
+
+    @staticmethod
+    def parse_id(resource_id):
+        region, number = resource_id.split('-', 1)[1].rsplit('-', 1)
+        return region, int(number)
+
+    # Tags of instance, every other instance has no Team yet, so update_tags has something to write
+    @staticmethod
+    def instance_tags(number):
+        tags = {'Name': 'node-{}'.format(number), 'Department': DEPARTMENTS[number % len(DEPARTMENTS)]}
+        if number % 2 == 0:
+            tags['Team'] = 'team-{}'.format(number % 7)
+        return tags
+
+    def instance(self, region, number):
+        return {'InstanceId': self.instance_id(region, number),
+                'InstanceType': self.instance_types[number % len(self.instance_types)],
+                'State': {'Name': 'running'},
+                'PrivateIpAddress': '10.0.{0}.{1}'.format(number // 256 % 256, number % 256),
+                'LaunchTime': LAUNCH_TIME,
+                'Tags': [{'Key': key, 'Value': value} for key, value in self.instance_tags(number).items()],
+                'BlockDeviceMappings': [{'DeviceName': '/dev/xvd{}'.format(chr(97 + disk)),
+                                         'Ebs': {'VolumeId': 'vol-{0}-{1:08d}'.format(region, number * 10 + disk)}}
+                                        for disk in range(self.volumes)]}
+
+    @staticmethod
+    def volume(volume_id):
+        _, number = SyntheticAccount.parse_id(volume_id)
+        return {'VolumeId': volume_id, 'Size': 8 + number % 500, 'Iops': 100 + number % 3000,
+                'VolumeType': VOLUME_TYPES[number % len(VOLUME_TYPES)]}
+
+    @staticmethod
+    def price_item(attributes, usd):
+        return json.dumps({'product': {'attributes': attributes},
+                           'terms': {'OnDemand': {'term': {'priceDimensions': {
+                               'dimension': {'pricePerUnit': {'USD': str(usd)}}}}}}})
+
+    # One page of products, EBS products are asked with productFamily filter
+    def get_products(self, params):
+        if any(item['Field'] == 'productFamily' for item in params['Filters']):
+            products = [self.price_item({'volumeApiName': volume_type}, 0.05 + i * 0.01)
+                        for i, volume_type in enumerate(VOLUME_TYPES)]
+        else:
+            products = [self.price_item({'instanceType': instance_type, 'memory': '{} GiB'.format(2 ** (i % 8)),
+                                         'vcpu': str(2 ** (i % 6))}, 0.01 * (i + 1))
+                        for i, instance_type in enumerate(self.instance_types)]
+        start = int(params.get('NextToken', 0))
+        response = {'PriceList': products[start:start + PRICE_PAGE_SIZE]}
+        if start + PRICE_PAGE_SIZE < len(products):
+            response['NextToken'] = str(start + PRICE_PAGE_SIZE)
+        return response
+
+    # One page of instances, department and ids are filtered like AWS does with tag:Department and instance-id
+    def describe_instances(self, region, params):
+        departments = [item['Values'] for item in params.get('Filters', []) if item['Name'] == 'tag:Department']
+        ids = [item['Values'] for item in params.get('Filters', []) if item['Name'] == 'instance-id']
+        numbers = range(self.region_size(region))
+        if ids:
+            numbers = [number for instance_region, number in map(self.parse_id, ids[0])
+                       if instance_region == region and number < self.region_size(region)]
+        if departments:
+            numbers = [number for number in numbers
+                       if DEPARTMENTS[number % len(DEPARTMENTS)] in departments[0]]
+        start = int(params.get('NextToken', 0))
+        response = {'Reservations': [{'Instances': [self.instance(region, number)
+                                                    for number in numbers[start:start + PAGE_SIZE]]}]}
+        if start + PAGE_SIZE < len(numbers):
+            response['NextToken'] = str(start + PAGE_SIZE)
+        return response
+
+    # Volumes filtered by id, or one page of all volumes of region
+    def describe_volumes(self, region, params):
+        ids = [item['Values'] for item in params.get('Filters', []) if item['Name'] == 'volume-id']
+        if ids:
+            return {'Volumes': [self.volume(volume_id) for volume_id in ids[0]]}
+        volume_ids = ['vol-{0}-{1:08d}'.format(region, number * 10 + disk)
+                      for number in range(self.region_size(region)) for disk in range(self.volumes)]
+        start = int(params.get('NextToken', 0))
+        response = {'Volumes': [self.volume(volume_id) for volume_id in volume_ids[start:start + PAGE_SIZE]]}
+        if start + PAGE_SIZE < len(volume_ids):
+            response['NextToken'] = str(start + PAGE_SIZE)
+        return response
+
+    def describe_tags(self, params):
+        filters = {item['Name']: item['Values'] for item in params.get('Filters', [])}
+        keys = set(filters.get('key', main.TAG_KEYS))
+        tags = []
+        for resource_id in filters.get('resource-id', []):
+            _, number = self.parse_id(resource_id)
+            tags += [{'ResourceId': resource_id, 'ResourceType': 'instance', 'Key': key, 'Value': value}
+                     for key, value in self.instance_tags(number).items() if key in keys]
+        return {'Tags': tags}
+
+    # Response of one AWS call
+    def respond(self, operation, region, params):
+        with self._lock:
+            self.calls[operation] += 1
+        if operation == 'GetCallerIdentity':
+            return {'Account': ACCOUNT_ID, 'Arn': 'arn:aws:iam::{}:user/benchmark'.format(ACCOUNT_ID),
+                    'UserId': 'benchmark'}
+        if operation == 'DescribeRegions':
+            return {'Regions': [{'RegionName': name, 'Endpoint': 'ec2.{}.amazonaws.com'.format(name)}
+                                for name in self.regions]}
+        if operation == 'GetProducts':
+            return self.get_products(params)
+        if operation == 'DescribeInstances':
+            return self.describe_instances(region, params)
+        if operation == 'DescribeVolumes':
+            return self.describe_volumes(region, params)
+        if operation == 'DescribeTags':
+            return self.describe_tags(params)
+        if operation == 'CreateTags':
+            return {}
+        raise Exception('Synthetic account does not answer {}'.format(operation))
+
+    # Parameters of call are kept for before-call, which gets only the serialized request
+    @staticmethod
+    def _keep_params(params, context, **kwargs):
+        context['synthetic_params'] = params
+
+    def _before_call(self, model, context, **kwargs):
+        parsed = self.respond(model.name, context.get('client_region'), context['synthetic_params'])
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+        return AWSResponse(None, 200, {}, None), parsed
+
+    # Session which answers all calls of its clients
+    def session(self):
+        session = boto3.session.Session(aws_access_key_id='synthetic', aws_secret_access_key='synthetic')
+        session.events.register('before-parameter-build', self._keep_params)
+        session.events.register('before-call', self._before_call)
+        return session
+
+
+# Class for AWS clients of synthetic account
+class SyntheticClients(main.AwsClients):
+
+    def __init__(self, account, max_pool_connections=main.DEFAULT_WORKERS):
+        super(SyntheticClients, self).__init__(max_pool_connections)
+        self.account = account
+
+    def _new_session(self, profile):
+        return self.account.session()
+
+
+# Class for synthetic kubernetes API, objects are built once so only the report is measured
+class SyntheticKubernetes(object):
+
+    def __init__(self, pods, pods_per_service=PODS_PER_SERVICE, containers=CONTAINERS_PER_POD, namespaces=20):
+        self.calls = collections.Counter()
+        self.namespaces = ['namespace-{}'.format(i) for i in range(namespaces)]
+        self.pods = [self.pod(number, containers) for number in range(pods)]
+        self.endpoints = [self.service(number, pods_per_service)
+                          for number in range((pods + pods_per_service - 1) // pods_per_service)]
+
+    def namespace(self, number):
+        return self.namespaces[number % len(self.namespaces)]
+
+    def pod(self, number, containers):
+        service = number // PODS_PER_SERVICE
+        requests = [{'cpu': '{}m'.format(50 + (number + i) % 20 * 50), 'memory': '{}Mi'.format(64 * (1 + i))}
+                    for i in range(containers)]
+        return client.V1Pod(
+            metadata=client.V1ObjectMeta(name='pod-{}'.format(number), namespace=self.namespace(service),
+                                         resource_version=str(number)),
+            spec=client.V1PodSpec(containers=[
+                client.V1Container(name='container-{}'.format(i),
+                                   resources=client.V1ResourceRequirements(requests=requests[i]))
+                for i in range(containers)]))
+
+    def service(self, number, pods_per_service):
+        pod_names = ['pod-{}'.format(pod) for pod in range(number * pods_per_service,
+                                                              min((number + 1) * pods_per_service, len(self.pods)))]
+        return client.V1Endpoints(
+            metadata=client.V1ObjectMeta(name='service-{}'.format(number), namespace=self.namespace(number),
+                                         labels={'owner': 'team-{}'.format(number % 7)},
+                                         resource_version=str(number)),
+            subsets=[client.V1EndpointSubset(addresses=[
+                client.V1EndpointAddress(ip='10.1.0.1', target_ref=client.V1ObjectReference(
+                    kind='Pod', name=pod_name, namespace=self.namespace(number))) for pod_name in pod_names])])
+
+    def list_namespace(self, **kwargs):
+        self.calls['list_namespace'] += 1
+        return client.V1NamespaceList(items=[client.V1Namespace(metadata=client.V1ObjectMeta(name=name))
+                                             for name in self.namespaces])
+
+    def list_pod_for_all_namespaces(self, **kwargs):
+        self.calls['list_pod_for_all_namespaces'] += 1
+        return client.V1PodList(items=self.pods, metadata=client.V1ListMeta(resource_version='1'))
+
+    def list_endpoints_for_all_namespaces(self, **kwargs):
+        self.calls['list_endpoints_for_all_namespaces'] += 1
+        return client.V1EndpointsList(items=self.endpoints, metadata=client.V1ListMeta(resource_version='1'))
+
+
+# Class for benchmark of all flows, every flow is run in its own empty folder
+class Benchmark(object):
+
+    def __init__(self, regions=DEFAULT_REGIONS, volumes=1, skus=DEFAULT_SKUS, workers=main.DEFAULT_WORKERS,
+                 trace_memory=True, output_format='xlsx'):
+        self.regions = regions
+        self.output_format = output_format
+        self.volumes = volumes
+        self.skus = skus
+        self.workers = workers
+        self.trace_memory = trace_memory
+
+    # Wall time and API calls are taken without tracing, peak memory with a second traced run
+    def _measure(self, flow, size, prepare):
+        results = {'flow': flow, 'size': size, 'output_format': self.output_format}
+        run, calls = prepare()
+        gc.collect()
+        start_time = time.time()
+        run()
+        results['seconds'] = round(time.time() - start_time, 3)
+        results['calls'] = dict(calls)
+        results['api_calls'] = sum(calls.values())
+
+        if self.trace_memory:
+            run, _ = prepare()
+            gc.collect()
+            tracemalloc.start()
+            run()
+            results['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0, 1)
+            tracemalloc.stop()
+        return results
+
+    def _prepare_report(self, size):
+        account = SyntheticAccount(size, self.regions, self.volumes, self.skus)
+        report = main.GetReports(workers=self.workers, price_cache=main.PriceCache(refresh=True),
+                                 clients=SyntheticClients(account, self.workers), output_format=self.output_format)
+        return lambda: report.get_report_excel('common'), account.calls
+
+    # File for update_tags with Team and Project set for every instance
+    def _write_tags_file(self, account, path):
+        with open(path, 'w', newline='') as tags_file:
+            writer = csv.writer(tags_file)
+            writer.writerow(main.REPORT_HEADERS)
+            for region in account.regions:
+                for number in range(account.region_size(region)):
+                    values = {'Region': region, 'ID': account.instance_id(region, number),
+                              'Department': DEPARTMENTS[number % len(DEPARTMENTS)],
+                              'Team': 'team-{}'.format(number % 7), 'Project': 'project-{}'.format(number % 3)}
+                    writer.writerow([values.get(header, '') for header in main.REPORT_HEADERS])
+
+    def _prepare_update_tags(self, size):
+        account = SyntheticAccount(size, self.regions, self.volumes, self.skus)
+        self._write_tags_file(account, 'tags.csv')
+        tags = main.UpdateTags('tags.csv', workers=self.workers, clients=SyntheticClients(account, self.workers))
+        return tags.update_tags, account.calls
+
+    def _prepare_kube_report(self, size):
+        api = SyntheticKubernetes(size)
+        report = main.GetReportKubernetes(context='synthetic.cluster', v1=api, output_format=self.output_format)
+        return report.get_report_excel, api.calls
+
+    # Measure one flow at one size in a temporary folder, reports and caches are removed after
+    def run_flow(self, flow, size):
+        prepare = {'report': self._prepare_report,
+                   'update_tags': self._prepare_update_tags,
+                   'kube-report': self._prepare_kube_report}[flow]
+        folder = tempfile.mkdtemp(prefix='benchmark-')
+        current = os.getcwd()
+        os.chdir(folder)
+        try:
+            return self._measure(flow, size, lambda: prepare(size))
+        finally:
+            os.chdir(current)
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def run(self, flows, sizes):
+        results = []
+        for size in sizes:
+            for flow in flows:
+                logger.info('Running {0} at size {1}'.format(flow, size))
+                result = self.run_flow(flow, size)
+                logger.info('{0} {1}: {2} seconds, {3} API calls, {4} MB peak memory'.format(
+                    flow, size, result['seconds'], result['api_calls'], result.get('peak_memory_mb', '-')))
+                results.append(result)
+        return results
+
+
+@click.command()
+@click.option(
+    '-s', '--sizes', default=DEFAULT_SIZES,
+    help='Comma separated numbers of instances or pods, by default it will be {}'.format(DEFAULT_SIZES),
+)
+@click.option(
+    '--flows', default=DEFAULT_FLOWS,
+    help='Comma separated flows to measure, by default it will be {}'.format(DEFAULT_FLOWS),
+)
+@click.option(
+    '-r', '--regions', default=DEFAULT_REGIONS, type=click.IntRange(min=1, max=len(REGIONS)),
+    help='Number of regions instances are spread over, by default it will be {}'.format(DEFAULT_REGIONS),
+)
+@click.option(
+    '--volumes', default=1, type=click.IntRange(min=0, max=26),
+    help='Volumes attached to every instance, by default it will be 1',
+)
+@click.option(
+    '--skus', default=DEFAULT_SKUS, type=click.IntRange(min=1),
+    help='Number of instance types in pricing, by default it will be {}'.format(DEFAULT_SKUS),
+)
+@click.option(
+    '-w', '--workers', default=main.DEFAULT_WORKERS, type=click.IntRange(min=1),
+    help='Number of regions handled in parallel, by default it will be {}'.format(main.DEFAULT_WORKERS),
+)
+@click.option(
+    '--trace-memory/--no-trace-memory', default=True,
+    help='Run every flow second time with tracemalloc for peak memory, by default it will be on',
+)
+@click.option(
+    '--output-format', default='xlsx', type=click.Choice(main.OUTPUT_FORMATS),
+    help='Format of report and kube-report files, by default it will be xlsx',
+)
+@click.option(
+    '-o', '--output',
+    help='Save results as json to this file',
+)
+def benchmark(sizes, flows, regions, volumes, skus, workers, trace_memory, output_format, output):
+    """
+
+    Benchmark of report, update_tags and kube-report flows on synthetic AWS accounts and kubernetes clusters.
+    AWS calls are answered by botocore event handlers and kubernetes API is replaced, nothing leaves the machine
+
+    Examples:
+
+    1. Measure all flows with 1k, 10k and 100k instances
+
+        benchmark.py
+
+    2. Measure only report with 10k instances in 16 regions and save results
+
+        benchmark.py -s 10000 --flows report -r 16 -o benchmark.json
+
+    3. Compare writing report as xlsx and as parquet
+
+        benchmark.py -s 100000 --flows report,kube-report --output-format parquet
+
+    """
+
+    flows = [flow.strip() for flow in flows.split(',') if flow.strip()]
+    for flow in flows:
+        if flow not in DEFAULT_FLOWS.split(','):
+            logger.info('Not existing flow - {0}, valid flows are: {1}'.format(flow, DEFAULT_FLOWS))
+            exit(1)
+
+    if output_format == 'parquet':
+        main.ParquetTableWriter.load_pyarrow()
+
+    results = Benchmark(regions, volumes, skus, workers, trace_memory, output_format).run(
+        flows, [int(size) for size in sizes.split(',')])
+
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        logger.info('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+    benchmark()
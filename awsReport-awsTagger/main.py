@@ -1,67 +1,1117 @@
 __author__ = 'Yevgeniy Ovsyannikov'
 
 import os
+import re
+import csv
 import time
+import signal
+import array
+import mmap
+import gzip
 import json
+import hashlib
+import fnmatch
+import sqlite3
 import xlrd
 import click
 import boto3
+import botocore.config
+import botocore.loaders
 import logging
 import datetime
+import zipfile
+import collections
+import contextlib
+import threading
+import queue
+import itertools
+import configparser
+import urllib3
 import xlsxwriter
-from kubernetes import client, config
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
 
 # Common
 date = datetime.datetime.now().strftime("%Y-%m-%d")
+DEFAULT_WORKERS = 10
+DEFAULT_MAX_ATTEMPTS = 10  # attempts of one AWS call with adaptive retries
+FILTER_BATCH_SIZE = 200  # max values in one describe filter
+TAG_BATCH_SIZE = 500  # instances in one create_tags call
+STREAM_BUFFER_SIZE = 1000  # instances collected ahead per region or account
+STREAM_DONE = object()
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+TAG_KEYS = ('Department', 'TeamOwner', 'Project', 'Finance', 'Team', 'Environment')
+PRICE_CACHE_DIR = os.path.join('cache', 'prices')
+DEFAULT_PRICE_CACHE_TTL = 24  # hours
+DEFAULT_PRICE_INDEX = os.path.join(PRICE_CACHE_DIR, 'offer-index.dat')
+PRICE_INDEX_MAGIC = 'AWSPRICEINDEX1'
+OFFER_CHUNK_SIZE = 1 << 20  # characters of offer file read at once
+DEFAULT_INVENTORY_TTL = 60  # minutes
+INVENTORY_BATCH_SIZE = 1000  # instances staged in inventory with one transaction
+PARQUET_ROW_GROUP_SIZE = 10000  # rows kept in memory before they are written to parquet file
+REGION_CACHE_DIR = os.path.join('cache', 'regions')
+DEFAULT_REGION_CATALOG_TTL = 24  # hours before enabled regions are described again
+DEFAULT_EMPTY_REGION_SKIP = 0  # hours, 0 means empty regions are probed on every run
+REGION_PROBE_SIZE = 5  # smallest MaxResults of describe_instances
+DEFAULT_KUBE_REPORT_INTERVAL = 3600  # seconds
+KUBE_WATCH_TIMEOUT = 300  # seconds before watch is reopened
+KUBE_WATCH_RETRY = 5  # seconds before watch is reopened after error
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+                  'EC2ThrottledException', 'BandwidthLimitExceeded', 'LimitExceededException')
+METRICS_PREFIX = 'aws_tool'
+# Calls per second per region to start with, EC2 refills its buckets with 20 describe and 5 mutating calls
+DEFAULT_DESCRIBE_RATE = 20
+DEFAULT_MUTATE_RATE = 5
+RATE_BURST = 5  # seconds of calls which can be made at once
+RATE_MAX_FACTOR = 4  # rate grows up to this times the starting rate while calls succeed
+RATE_MIN = 0.5  # calls per second, rate is never halved below it
+DESCRIBE_PREFIXES = ('Describe', 'List', 'Get')
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p')
 
 
+# Layout of EC2 report: header, width, header color and tag shown in the column.
+# update_tags reads files in the same layout
+REPORT_COLUMNS = [
+    ('Region', 10, 'red', None),
+    ('Instance name', 40, 'red', 'Name'),
+    ('ID', 20, 'red', None),
+    ('Type', 15, 'red', None),
+    ('State', 10, 'red', None),
+    ('Public IP', 15, 'red', None),
+    ('Launch time', 20, 'red', None),
+    ('Department', 40, 'brown', 'Department'),
+    ('Team', 20, 'brown', 'Team'),
+    ('Team Owner', 20, 'brown', 'TeamOwner'),
+    ('Project', 20, 'brown', 'Project'),
+    ('Finance', 10, 'brown', 'Finance'),
+    ('Environment', 20, 'brown', 'Environment'),
+    ('Compute monthly cost (USD)', 40, 'green', None),
+    ('Storage monthly cost (USD)', 40, 'green', None),
+    ('Compute + Storage monthly cost (USD)', 50, 'green', None),
+    ('Block devices size (GB)', 30, 'red', None),
+]
+REPORT_HEADERS = [header for header, _, _, _ in REPORT_COLUMNS]
+
+# Report columns read into TagRow by update_tags
+TAG_ROW_COLUMNS = [REPORT_HEADERS.index(header) for header in
+                   ('Region', 'ID', 'Department', 'Team', 'Team Owner', 'Project', 'Finance', 'Environment')]
+
+
+# Tables of inventory store
+INVENTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS regions (account TEXT, region TEXT, refreshed_at REAL, PRIMARY KEY (account, region));
+CREATE TABLE IF NOT EXISTS instances (account TEXT, region TEXT, instance_id TEXT, data TEXT,
+                                      PRIMARY KEY (account, instance_id));
+CREATE INDEX IF NOT EXISTS instances_region ON instances (account, region);
+CREATE TABLE IF NOT EXISTS tags (account TEXT, instance_id TEXT, key TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS tags_instance ON tags (account, instance_id);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (account, key, value);
+CREATE TABLE IF NOT EXISTS staged_instances (account TEXT, region TEXT, instance_id TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS staged_instances_region ON staged_instances (account, region);
+CREATE TABLE IF NOT EXISTS staged_tags (account TEXT, region TEXT, instance_id TEXT, key TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS staged_tags_region ON staged_tags (account, region);
+'''
+
+# Layout of kubernetes report: header, width and whether column is centered
+KUBE_REPORT_COLUMNS = [
+    ('Service Name', 45, False),
+    ('Namespace', 30, False),
+    ('Owner', 10, True),
+    ('Number of pods', 15, True),
+    ('CPU (one pod)', 15, False),
+    ('RAM (one pod)', 15, False),
+    ('CPU (total)', 20, False),
+    ('RAM (total)', 20, False),
+    ('Price per CPU (USD)', 25, True),
+    ('Price per RAM (USD)', 25, True),
+]
+
+# Columns of namespace and owner summaries of kubernetes report, after the namespace or owner column
+KUBE_SUMMARY_COLUMNS = [
+    ('Services', 15, True),
+    ('Number of pods', 15, True),
+    ('CPU (total)', 20, False),
+    ('RAM (total)', 20, False),
+    ('Price per CPU (USD)', 25, True),
+    ('Price per RAM (USD)', 25, True),
+    ('Price total (USD)', 25, True),
+]
+
+# Types of report columns in csv, jsonl and parquet files, other columns are strings.
+# A list is kept as structured column, a list with dict is a list of records with these fields
+TABLE_COLUMN_TYPES = {
+    'Compute monthly cost (USD)': 'number',
+    'Storage monthly cost (USD)': 'number',
+    'Compute + Storage monthly cost (USD)': 'number',
+    'Block devices size (GB)': ['integer'],
+    'Block devices': [collections.OrderedDict([('volume_id', 'string'), ('volume_type', 'string'),
+                                               ('volume_size', 'integer'), ('volume_iops', 'integer'),
+                                               ('volume_price_per_month', 'number')])],
+    'Services': 'integer',
+    'Number of pods': 'integer',
+    'CPU (one pod)': 'integer',
+    'RAM (one pod)': 'integer',
+    'CPU (total)': 'integer',
+    'RAM (total)': 'integer',
+    'Price per CPU (USD)': 'number',
+    'Price per RAM (USD)': 'number',
+    'Price total (USD)': 'number',
+    'Pods': ['string'],
+}
+
+# Columns of AWS bulk offer csv and attributes of offer json with the same data
+OFFER_CSV_COLUMNS = {
+    'Product Family': 'productFamily',
+    'Location': 'location',
+    'Location Type': 'locationType',
+    'Region Code': 'regionCode',
+    'Instance Type': 'instanceType',
+    'Operating System': 'operatingSystem',
+    'Tenancy': 'tenancy',
+    'Pre Installed S/W': 'preInstalledSw',
+    'CapacityStatus': 'capacitystatus',
+    'License Model': 'licenseModel',
+    'Volume API Name': 'volumeApiName',
+}
+
+# Operating systems and tenancies of instances as they are named in AWS pricing
+PRICE_OPERATING_SYSTEMS = {
+    'Linux/UNIX': 'Linux',
+    'Red Hat Enterprise Linux': 'RHEL',
+    'SUSE Linux': 'SUSE',
+    'Ubuntu Pro': 'Ubuntu Pro',
+    'Windows': 'Windows',
+}
+PRICE_TENANCIES = {'default': 'Shared', 'dedicated': 'Dedicated', 'host': 'Host'}
+
+# Suffixes of kubernetes quantities
+QUANTITY_PATTERN = re.compile(r'^([+-]?[0-9]*\.?[0-9]+)([eE][+-]?[0-9]+)?(Ki|Mi|Gi|Ti|Pi|Ei|n|u|m|k|M|G|T|P|E)?$')
+QUANTITY_SUFFIXES = {'': 1, 'n': 1e-9, 'u': 1e-6, 'm': 1e-3,
+                     'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+                     'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60}
+
+
+# Filters for AWS pricing, prices are taken for US East (N. Virginia)
+EC2_PRICE_FILTERS = [
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'operatingSystem',
+        'Value': 'Linux'
+    },
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'location',
+        'Value': 'US East (N. Virginia)'
+    },
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'tenancy',
+        'Value': 'Shared'
+    },
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'preInstalledSw',
+        'Value': 'NA'
+    },
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'capacitystatus',
+        'Value': 'Used'
+    }
+]
+
+EBS_PRICE_FILTERS = [
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'productFamily',
+        'Value': 'Storage'
+    },
+    {
+        'Type': 'TERM_MATCH',
+        'Field': 'location',
+        'Value': 'US East (N. Virginia)'
+    }
+]
+
+
+# Run generator func for every key in parallel, up to workers at a time, and yield its items in the order of keys.
+# Every key buffers at most STREAM_BUFFER_SIZE items, so memory does not grow with the fleet
+def stream_parallel(keys, func, workers):
+    queues = [queue.Queue(maxsize=STREAM_BUFFER_SIZE) for _ in keys]
+    stopped = threading.Event()
+
+    def put(items, value):
+        while not stopped.is_set():
+            try:
+                items.put(value, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(key, items):
+        if stopped.is_set():
+            return
+        try:
+            for item in func(key):
+                if not put(items, (item, None)):
+                    return
+        # Exit of worker is passed on too, otherwise consumer waits for its items forever
+        except BaseException as exception:
+            put(items, (None, exception))
+            return
+        put(items, (STREAM_DONE, None))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(keys))))
+    try:
+        for key, items in zip(keys, queues):
+            executor.submit(produce, key, items)
+        for items in queues:
+            while True:
+                item, exception = items.get()
+                if exception is not None:
+                    raise exception
+                if item is STREAM_DONE:
+                    break
+                yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
+
+
+# Class for trace of one run: phases and regions timings, API calls, retries, throttles and processed rows.
+# Phases which run in several workers are summed up, so their time can be bigger than time of the run
+class RunTrace(object):
+
+    def __init__(self, flow=None):
+        self.flow = flow
+        self.started = time.time()
+        self.phases = collections.OrderedDict()
+        self.regions = collections.OrderedDict()
+        self.api_calls = collections.Counter()
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    # Measure block of code as phase
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start_time)
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            total, count = self.phases.get(name, (0, 0))
+            self.phases[name] = (total + seconds, count + 1)
+
+    def add_region(self, region, seconds):
+        with self._lock:
+            self.regions[region] = self.regions.get(region, 0) + seconds
+
+    # Count of processed things, rows, instances, tags and so on
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def call(self, operation, retries=0):
+        with self._lock:
+            self.api_calls[operation] += 1
+            if retries:
+                self.counters['retries'] += retries
+
+    # Count calls of botocore session and all its clients
+    def register(self, events):
+        events.register('after-call', self._after_call)
+        events.register('after-call-error', self._after_call_error)
+        events.register('needs-retry', self._needs_retry)
+
+    def _after_call(self, model, parsed, **kwargs):
+        self.call('{0}.{1}'.format(model.service_model.service_name, model.name),
+                  parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+    # Call failed without response, like connection error. Botocore gives only exception and context,
+    # so operation is taken from event name after-call-error.<service>.<operation>
+    def _after_call_error(self, exception, model=None, event_name='', **kwargs):
+        if model is not None:
+            operation = '{0}.{1}'.format(model.service_model.service_name, model.name)
+        else:
+            operation = '.'.join(event_name.split('.')[1:3])
+        response = getattr(exception, 'response', None) or {}
+        self.call(operation, response.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+        self.count('errors')
+
+    def _needs_retry(self, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            self.count('throttles')
+
+    def to_dict(self):
+        with self._lock:
+            return {'flow': self.flow,
+                    'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                    'seconds': round(time.time() - self.started, 3),
+                    'phases': collections.OrderedDict((name, {'seconds': round(total, 3), 'count': count})
+                                                      for name, (total, count) in self.phases.items()),
+                    'regions': collections.OrderedDict((region, round(seconds, 3))
+                                                       for region, seconds in sorted(self.regions.items())),
+                    'api_calls': dict(self.api_calls),
+                    'counters': dict(self.counters)}
+
+    # Short summary of the run
+    def log_summary(self):
+        trace = self.to_dict()
+        logging.info('Phases: {}'.format(', '.join('{0} {1}s'.format(name, phase['seconds'])
+                                                   for name, phase in trace['phases'].items())))
+        logging.info('API calls: {0}, retries: {1}, throttles: {2}'.format(
+            sum(trace['api_calls'].values()), trace['counters'].get('retries', 0),
+            trace['counters'].get('throttles', 0)))
+        if trace['regions']:
+            slowest = max(trace['regions'], key=trace['regions'].get)
+            logging.info('Slowest region: {0} {1}s'.format(slowest, trace['regions'][slowest]))
+
+    def write(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump(self.to_dict(), trace_file, indent=2)
+        logging.info('Trace saved to {}'.format(path))
+
+    # Prometheus textfile, written to temporary file and renamed, so collector never reads half of it
+    def write_prometheus(self, path):
+        trace = self.to_dict()
+        flow = 'flow="{}"'.format(trace['flow'])
+        lines = ['# TYPE {0}_run_seconds gauge'.format(METRICS_PREFIX),
+                 '{0}_run_seconds{{{1}}} {2}'.format(METRICS_PREFIX, flow, trace['seconds']),
+                 '# TYPE {0}_phase_seconds gauge'.format(METRICS_PREFIX)]
+        lines += ['{0}_phase_seconds{{{1},phase="{2}"}} {3}'.format(METRICS_PREFIX, flow, name, phase['seconds'])
+                  for name, phase in trace['phases'].items()]
+        lines.append('# TYPE {0}_region_seconds gauge'.format(METRICS_PREFIX))
+        lines += ['{0}_region_seconds{{{1},region="{2}"}} {3}'.format(METRICS_PREFIX, flow, region, seconds)
+                  for region, seconds in trace['regions'].items()]
+        lines.append('# TYPE {0}_api_calls counter'.format(METRICS_PREFIX))
+        lines += ['{0}_api_calls{{{1},operation="{2}"}} {3}'.format(METRICS_PREFIX, flow, operation, count)
+                  for operation, count in sorted(trace['api_calls'].items())]
+        lines.append('# TYPE {0}_count counter'.format(METRICS_PREFIX))
+        lines += ['{0}_count{{{1},name="{2}"}} {3}'.format(METRICS_PREFIX, flow, name, count)
+                  for name, count in sorted(trace['counters'].items())]
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+        logging.info('Metrics saved to {}'.format(path))
+
+
+# Class for rate and concurrency of calls of one profile, service, region and kind of calls.
+# Token bucket, rate and concurrency grow additively while calls succeed and are halved when AWS throttles
+class RateBucket(object):
+
+    def __init__(self, rate, concurrency):
+        self.rate = rate
+        self.max_rate = rate * RATE_MAX_FACTOR
+        self.burst = max(1, rate * RATE_BURST)
+        self.tokens = self.burst
+        self.concurrency = concurrency
+        self.max_concurrency = concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.updated = time.time()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Wait for token and free slot, returns seconds waited
+    def acquire(self):
+        start_time = time.time()
+        with self._condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and self.in_flight < self.concurrency:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return time.time() - start_time
+                self._condition.wait((1 - self.tokens) / self.rate if self.tokens < 1 else None)
+
+    def release(self, succeeded):
+        with self._condition:
+            self.in_flight -= 1
+            if succeeded:
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+                self.successes += 1
+                if self.successes >= self.concurrency:
+                    self.successes = 0
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self._condition.notify_all()
+
+    def throttled(self):
+        with self._condition:
+            self.rate = max(RATE_MIN, self.rate / 2)
+            self.concurrency = max(1, self.concurrency // 2)
+            self.tokens = min(self.tokens, 0)
+            self.successes = 0
+
+
+# Class for rate of AWS calls of the whole run, bucket per profile, service, region and kind of calls:
+# describe for Describe, List and Get calls and mutate for all others, like create_tags.
+# Concurrency of bucket limits calls of workers which share a region, like tagging batches of one region
+class RateController(object):
+
+    def __init__(self, describe_rate=DEFAULT_DESCRIBE_RATE, mutate_rate=DEFAULT_MUTATE_RATE,
+                 concurrency=DEFAULT_WORKERS, trace=None):
+        self.rates = {'describe': describe_rate, 'mutate': mutate_rate}
+        self.concurrency = concurrency
+        self.trace = trace
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, profile, service, region, operation):
+        kind = 'describe' if operation.startswith(DESCRIBE_PREFIXES) else 'mutate'
+        key = (profile, service, region, kind)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = RateBucket(self.rates[kind], self.concurrency)
+            return self._buckets[key]
+
+    # Control calls of botocore session and all its clients, bucket is kept in context of the call.
+    # Slot is released before other handlers run, so a failing handler can not leak it. Call succeeded only
+    # when it has response without error, connection errors and throttles left after retries are failures
+    def register(self, events, profile):
+        def before_call(model, context, **kwargs):
+            bucket = self.bucket(profile, model.service_model.service_name, context.get('client_region'), model.name)
+            waited = bucket.acquire()
+            context['rate_bucket'] = bucket
+            if self.trace is not None and waited > 0:
+                self.trace.add_phase('rate_wait', waited)
+
+        def after_call(context, parsed=None, **kwargs):
+            bucket = context.pop('rate_bucket', None)
+            if bucket is not None:
+                bucket.release(parsed is not None and not parsed.get('Error'))
+
+        def needs_retry(request_dict=None, response=None, **kwargs):
+            context = (request_dict or {}).get('context', {})
+            if 'rate_bucket' in context and response is not None and \
+                    response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+                context['rate_bucket'].throttled()
+
+        events.register('before-call', before_call)
+        events.register_first('after-call', after_call)
+        events.register_first('after-call-error', after_call)
+        events.register('needs-retry', needs_retry)
+
+
+# Class for AWS clients of the whole run, one client per profile, service and region.
+# Clients are thread safe, their connection pool is as big as the number of workers
+class AwsClients(object):
+
+    def __init__(self, max_pool_connections=DEFAULT_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS, trace=None,
+                 rate=None):
+        self.trace = trace
+        self.rate = rate
+        self.config = botocore.config.Config(max_pool_connections=max_pool_connections,
+                                             retries={'mode': 'adaptive', 'max_attempts': max_attempts})
+        self._sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    # Return client, it is created on first use, sessions are used only under the lock
+    def get(self, service, region, profile=None):
+        key = (profile, service, region)
+        with self._lock:
+            if key not in self._clients:
+                if profile not in self._sessions:
+                    self._sessions[profile] = self._new_session(profile)
+                    if self.trace is not None:
+                        self.trace.register(self._sessions[profile].events)
+                    if self.rate is not None:
+                        self.rate.register(self._sessions[profile].events, profile)
+                self._clients[key] = self._sessions[profile].client(service, region_name=region, config=self.config)
+            return self._clients[key]
+
+    # New session of profile
+    def _new_session(self, profile):
+        return boto3.session.Session(profile_name=profile)
+
+
+# Prices are not cached and can not be fetched in offline mode. Raised in workers, the flow stops in main
+class PriceCacheError(Exception):
+    pass
+
+
+# Class for local cache of AWS pricing
+class PriceCache(object):
+
+    def __init__(self, directory=PRICE_CACHE_DIR, ttl=DEFAULT_PRICE_CACHE_TTL, refresh=False, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.refresh = refresh
+        self.offline = offline
+
+    # Every service and filter set has its own file
+    def _path(self, service, filters):
+        key = hashlib.sha1(json.dumps([service, filters], sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{0}-{1}.json'.format(service, key[:16]))
+
+    # Return cached products or fetch them and update the cache
+    def get(self, service, filters, fetch):
+        path = self._path(service, filters)
+        if os.path.exists(path) and not self.refresh:
+            age = time.time() - os.path.getmtime(path)
+            if self.offline or age < self.ttl * 3600:
+                with open(path) as cache_file:
+                    return json.load(cache_file)
+            logging.info('Cached prices {0} are {1} hours old, refreshing'.format(path, round(age / 3600, 1)))
+
+        if self.offline:
+            raise PriceCacheError('No cached prices for {0} under {1}, run once without offline mode'.format(
+                service, self.directory))
+
+        products = fetch()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(products, cache_file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        return products
+
+
+# Class for reading AWS bulk offer json piece by piece, offer of EC2 is gigabytes.
+# Only members of objects which are asked for are decoded, everything else is skipped while it is read
+class OfferJsonReader(object):
+
+    # Strings are matched whole, so brackets inside them are not counted. A string cut by end of buffer is incomplete
+    SKIP_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*("|\\?\Z)|[{}\[\]]')
+    WHITESPACE_PATTERN = re.compile(r'\s*')
+    NUMBER_TAIL_PATTERN = re.compile(r'[0-9.eE+-]*\Z')
+
+    def __init__(self, stream, chunk_size=OFFER_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    # Read next chunk, consumed part of buffer is dropped
+    def _fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return len(chunk) > 0
+
+    # Next character which is not whitespace, it is not consumed
+    def _peek(self):
+        while True:
+            self.pos = self.WHITESPACE_PATTERN.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('Offer file ends unexpectedly')
+
+    def _consume(self, expected):
+        char = self._peek()
+        if char not in expected:
+            raise ValueError('Expected one of {0} in offer file, got {1}'.format(
+                expected, self.buffer[self.pos:self.pos + 40]))
+        self.pos += 1
+        return char
+
+    # Decode next value, buffer grows until value is complete
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # Number at end of buffer may go on in next chunk, even when only its fraction or exponent is left out
+            if (end == len(self.buffer) or isinstance(value, (int, float)) and
+                    self.NUMBER_TAIL_PATTERN.match(self.buffer, end)) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    # Skip next value without decoding it
+    def skip(self):
+        if self._peek() not in '{[':
+            self.value()
+            return
+        depth = 0
+        while True:
+            resume = len(self.buffer)
+            for match in self.SKIP_PATTERN.finditer(self.buffer, self.pos):
+                token = match.group()
+                if token[0] == '"':
+                    if match.group(1) != '"':
+                        resume = match.start()
+                        break
+                elif token in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        self.pos = match.end()
+                        return
+            self.pos = resume
+            if not self._fill():
+                raise ValueError('Offer file ends unexpectedly')
+
+    # Yield keys of next object one by one, value of every key is read with value or skip before next key
+    def members(self):
+        self._consume('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._consume(':')
+            yield key
+            if self._consume(',}') == '}':
+                return
+
+
+# Class for compact price index built by ingest-prices. Index is one file: header, offsets of records and records
+# sorted by region, product, operating system and tenancy, with hourly price of instance or monthly price of GB.
+# File is memory mapped and records are found with binary search, so loading it costs nothing
+class PriceIndex(object):
+
+    def __init__(self, path=DEFAULT_PRICE_INDEX):
+        self.path = path
+        self._regions = {}
+        self._lock = threading.Lock()
+        with open(path, 'rb') as index_file:
+            self._data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_end = self._data.find(b'\n')
+        header = self._data[:header_end].decode('utf-8').split()
+        if len(header) != 2 or header[0] != PRICE_INDEX_MAGIC:
+            logging.info('{} is not a price index, build it with ingest-prices'.format(path))
+            exit(1)
+        self._offsets = memoryview(self._data)[header_end + 1:header_end + 1 + int(header[1]) * 8].cast('Q')
+
+    # Fields of record: region, product, operating system, tenancy and price
+    def _record(self, number):
+        start = self._offsets[number]
+        return self._data[start:self._data.find(b'\n', start)].decode('utf-8').split('\t')
+
+    # Number of first record with key not less than given one
+    def _search(self, key):
+        low, high = 0, len(self._offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if tuple(self._record(middle)[:4]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Lookups of one region like pricing API ones: instance prices keyed by type, operating system and tenancy,
+    # volume prices keyed by type. None when region is not in the index
+    def region_prices(self, region):
+        with self._lock:
+            if region not in self._regions:
+                ec2_price_index = {}
+                ebs_price_index = {}
+                number = self._search((region,))
+                while number < len(self._offsets):
+                    record_region, product, operating_system, tenancy, price = self._record(number)
+                    if record_region != region:
+                        break
+                    if operating_system:
+                        ec2_price_index[(product, operating_system, tenancy)] = float(price)
+                    else:
+                        ebs_price_index[product] = float(price)
+                    number += 1
+                self._regions[region] = (ec2_price_index, ebs_price_index) \
+                    if ec2_price_index or ebs_price_index else None
+                if self._regions[region] is None:
+                    logging.info('Region {0} is not in price index {1}, it is priced by US East (N. Virginia)'.format(
+                        region, self.path))
+            return self._regions[region]
+
+    # Save records {(region, product, operating system, tenancy): price} as index, file is replaced at once
+    @staticmethod
+    def write(path, records):
+        lines = [('\t'.join(key + ('{}'.format(price),)) + '\n').encode('utf-8')
+                 for key, price in sorted(records.items())]
+        header = '{0} {1}\n'.format(PRICE_INDEX_MAGIC, len(lines)).encode('utf-8')
+        offsets = array.array('Q')
+        position = len(header) + offsets.itemsize * len(lines)
+        for line in lines:
+            offsets.append(position)
+            position += len(line)
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(header)
+            index_file.write(offsets.tobytes())
+            for line in lines:
+                index_file.write(line)
+        os.replace(tmp_path, path)
+
+
+# Class for local catalog of regions per account: enabled regions and which of them had instances last time.
+# Regions are chosen with include and exclude patterns like eu-*
+class RegionCatalog(object):
+
+    def __init__(self, directory=REGION_CACHE_DIR, ttl=DEFAULT_REGION_CATALOG_TTL, empty_skip=DEFAULT_EMPTY_REGION_SKIP,
+                 include=None, exclude=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.empty_skip = empty_skip
+        self.include = [pattern for pattern in include or [] if pattern]
+        self.exclude = [pattern for pattern in exclude or [] if pattern]
+        self._catalogs = {}
+        self._lock = threading.Lock()
+
+    def _path(self, account_id):
+        return os.path.join(self.directory, '{}.json'.format(account_id))
+
+    # Catalog of account, read from file once per run
+    def _load(self, account_id):
+        if account_id not in self._catalogs:
+            catalog = {'regions': None, 'updated': 0, 'seen': {}}
+            if os.path.exists(self._path(account_id)):
+                with open(self._path(account_id)) as catalog_file:
+                    catalog.update(json.load(catalog_file))
+            self._catalogs[account_id] = catalog
+        return self._catalogs[account_id]
+
+    def _save(self, account_id):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = '{}.tmp'.format(self._path(account_id))
+        with open(tmp_path, 'w') as catalog_file:
+            json.dump(self._catalogs[account_id], catalog_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path(account_id))
+
+    # Check region against include and exclude patterns
+    def selected(self, region):
+        if self.include and not any(fnmatch.fnmatch(region, pattern) for pattern in self.include):
+            return False
+        return not any(fnmatch.fnmatch(region, pattern) for pattern in self.exclude)
+
+    # Enabled and selected regions of account, describe is called when catalog is older than ttl
+    def regions(self, account_id, describe):
+        with self._lock:
+            catalog = self._load(account_id)
+            if catalog['regions'] is None or time.time() - catalog['updated'] > self.ttl * 3600:
+                catalog['regions'] = describe()
+                catalog['updated'] = time.time()
+                self._save(account_id)
+            return [region for region in catalog['regions'] if self.selected(region)]
+
+    # State of region: active when it had instances, empty while empty region window lasts, unknown otherwise
+    def state(self, account_id, region):
+        with self._lock:
+            seen = self._load(account_id)['seen'].get(region)
+        if seen is None:
+            return 'unknown'
+        if seen['instances']:
+            return 'active'
+        if time.time() - seen['checked'] < self.empty_skip * 3600:
+            return 'empty'
+        return 'unknown'
+
+    def update(self, account_id, region, instances):
+        with self._lock:
+            self._load(account_id)['seen'][region] = {'checked': time.time(), 'instances': instances}
+            self._save(account_id)
+
+
+# Class for local SQLite inventory of EC2 instances, filled by GetReports per account and region
+class InventoryStore(object):
+
+    def __init__(self, path, ttl=DEFAULT_INVENTORY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(INVENTORY_SCHEMA)
+
+    # Regions which were never collected or were collected more than ttl minutes ago
+    def stale_regions(self, account_id, regions):
+        with self.lock:
+            refreshed = dict(self.connection.execute(
+                'SELECT region, refreshed_at FROM regions WHERE account = ?', (account_id,)))
+        now = time.time()
+        return [region for region in regions if now - refreshed.get(region, 0) >= self.ttl * 60]
+
+    # Replacing all instances of a region, instances could be any iterable. Instances are staged batch by batch
+    # and swapped in at the end, so the lock is never held while instances are collected and readers never see
+    # half of a region
+    def replace_region(self, account_id, region, instances):
+        self._clear_staged(account_id, region)
+        batch = []
+        for instance in instances:
+            batch.append(instance)
+            if len(batch) >= INVENTORY_BATCH_SIZE:
+                self._stage(account_id, region, batch)
+                batch = []
+        self._stage(account_id, region, batch)
+
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM tags WHERE account = ? AND instance_id IN '
+                                    '(SELECT instance_id FROM instances WHERE account = ? AND region = ?)',
+                                    (account_id, account_id, region))
+            self.connection.execute('DELETE FROM instances WHERE account = ? AND region = ?', (account_id, region))
+            self.connection.execute('INSERT OR REPLACE INTO instances SELECT account, region, instance_id, data '
+                                    'FROM staged_instances WHERE account = ? AND region = ? ORDER BY rowid',
+                                    (account_id, region))
+            self.connection.execute('INSERT INTO tags SELECT account, instance_id, key, value FROM staged_tags '
+                                    'WHERE account = ? AND region = ?', (account_id, region))
+            self.connection.execute('INSERT OR REPLACE INTO regions VALUES (?, ?, ?)',
+                                    (account_id, region, time.time()))
+        self._clear_staged(account_id, region)
+
+    # Staging one batch of instances of region with one short transaction
+    def _stage(self, account_id, region, instances):
+        if not instances:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO staged_instances VALUES (?, ?, ?, ?)',
+                                        [(account_id, region, instance['InstanceId'],
+                                          json.dumps(instance, default=str, separators=(',', ':')))
+                                         for instance in instances])
+            self.connection.executemany('INSERT INTO staged_tags VALUES (?, ?, ?, ?, ?)',
+                                        [(account_id, region, instance['InstanceId'], tag['Key'], tag['Value'])
+                                         for instance in instances for tag in instance['Tags']])
+
+    # Removing staged instances of region, left over by a run which failed too
+    def _clear_staged(self, account_id, region):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM staged_instances WHERE account = ? AND region = ?',
+                                    (account_id, region))
+            self.connection.execute('DELETE FROM staged_tags WHERE account = ? AND region = ?', (account_id, region))
+
+    # Instances of account in the order of regions, optionally only of one department
+    def iter_instances(self, account_id, regions, department=None):
+        for region in regions:
+            if department is None:
+                query = ('SELECT data FROM instances WHERE account = ? AND region = ? ORDER BY rowid',
+                         (account_id, region))
+            else:
+                query = ('SELECT i.data FROM instances i JOIN tags t ON t.account = i.account AND '
+                         't.instance_id = i.instance_id WHERE i.account = ? AND i.region = ? AND '
+                         "t.key = 'Department' AND t.value = ? ORDER BY i.rowid", (account_id, region, department))
+            with self.lock:
+                rows = self.connection.execute(*query).fetchall()
+            for (data,) in rows:
+                yield json.loads(data)
+
+    # Instance ids of account found in region, None when region was never collected
+    def region_instance_ids(self, account_id, region):
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM regions WHERE account = ? AND region = ?',
+                                       (account_id, region)).fetchone() is None:
+                return None
+            return set(instance_id for (instance_id,) in self.connection.execute(
+                'SELECT instance_id FROM instances WHERE account = ? AND region = ?', (account_id, region)))
+
+
+# Base class for writing report rows as one table file, for loading reports in bulk without parsing spreadsheets.
+# Rows are records keyed by headers, they are written as they come
+class TableWriter(object):
+    extension = None
+
+    def __init__(self, path, headers):
+        self.path = '{0}.{1}'.format(path, self.extension)
+        self.columns = [(header, TABLE_COLUMN_TYPES.get(header, 'string')) for header in headers]
+        self.rows = 0
+
+    def write(self, record):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+# Csv table, structured columns are saved as json
+class CsvTableWriter(TableWriter):
+    extension = 'csv'
+
+    def __init__(self, path, headers):
+        super(CsvTableWriter, self).__init__(path, headers)
+        self.file = open(self.path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(headers)
+
+    def write(self, record):
+        self.writer.writerow([json.dumps(record.get(header)) if isinstance(column_type, list) else record.get(header)
+                              for header, column_type in self.columns])
+        self.rows += 1
+
+    def close(self):
+        self.file.close()
+
+
+# Json lines table, one record per line
+class JsonLinesTableWriter(TableWriter):
+    extension = 'jsonl'
+
+    def __init__(self, path, headers):
+        super(JsonLinesTableWriter, self).__init__(path, headers)
+        self.file = open(self.path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        self.file.write(json.dumps(collections.OrderedDict((header, record.get(header)) for header, _ in self.columns),
+                                   default=str))
+        self.file.write('\n')
+        self.rows += 1
+
+    def close(self):
+        self.file.close()
+
+
+# Parquet table, rows are written by row groups. pyarrow is needed only for it, so it is imported on first use
+class ParquetTableWriter(TableWriter):
+    extension = 'parquet'
+
+    def __init__(self, path, headers):
+        super(ParquetTableWriter, self).__init__(path, headers)
+        self.pyarrow, parquet = self.load_pyarrow()
+        self.schema = self.pyarrow.schema([(header, self._arrow_type(column_type))
+                                           for header, column_type in self.columns])
+        self.writer = parquet.ParquetWriter(self.path, self.schema)
+        self.batch = []
+
+    @staticmethod
+    def load_pyarrow():
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logging.info('Parquet output needs pyarrow, install it with pip install pyarrow')
+            exit(1)
+        return pyarrow, pyarrow.parquet
+
+    def _arrow_type(self, column_type):
+        if isinstance(column_type, list):
+            return self.pyarrow.list_(self._arrow_type(column_type[0]))
+        if isinstance(column_type, dict):
+            return self.pyarrow.struct([(name, self._arrow_type(field_type))
+                                        for name, field_type in column_type.items()])
+        return {'string': self.pyarrow.string(), 'integer': self.pyarrow.int64(),
+                'number': self.pyarrow.float64()}[column_type]
+
+    def write(self, record):
+        self.batch.append(record)
+        self.rows += 1
+        if len(self.batch) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.batch:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+# Table writers by output format, xlsx is written by reports themselves
+TABLE_WRITERS = collections.OrderedDict([('csv', CsvTableWriter), ('jsonl', JsonLinesTableWriter),
+                                         ('parquet', ParquetTableWriter)])
+OUTPUT_FORMATS = ['xlsx'] + list(TABLE_WRITERS)
+
+
 # Class  fo reports flow
 class GetReports(object):
 
-    # Return all regions
-    @staticmethod
-    def get_all_regions():
-        client = boto3.client("ec2")
-        regions = [region['RegionName'] for region in client.describe_regions()['Regions']]
-        return regions
+    def __init__(self, profile=None, workers=DEFAULT_WORKERS, price_cache=None, volumes='attached', inventory=None,
+                 prices=None, clients=None, trace=None, catalog=None, price_index=None, output_format='xlsx'):
+        self.profile = profile
+        self.output_format = output_format
+        self.workers = workers
+        self.trace = trace if trace is not None else RunTrace('report')
+        self.clients = clients if clients is not None else AwsClients(workers, trace=self.trace)
+        self.volumes = volumes
+        self.inventory = inventory
+        self.prices = prices
+        self.price_index = price_index
+        self.price_cache = price_cache if price_cache is not None else PriceCache()
+        self.catalog = catalog if catalog is not None else RegionCatalog()
+        self._account_id = None
+        self._regions = None
+        self._report_regions = None
+        self._price_indexes = None
+        self._prices_lock = threading.Lock()
+
+    # Return all enabled and selected regions, they are taken from region catalog while it is fresh
+    def get_all_regions(self):
+        if self._regions is None:
+            self._regions = self.catalog.regions(self.get_account_id(), self._describe_regions)
+        return self._regions
+
+    def _describe_regions(self):
+        client = self._client("ec2", 'us-east-1')
+        with self.trace.phase('describe_regions'):
+            return [region['RegionName'] for region in client.describe_regions()['Regions']]
+
+    # Regions worth scanning: regions which had instances last time and regions where probe finds instances.
+    # Regions found empty are probed on every run or skipped while empty region window lasts
+    def get_report_regions(self):
+        if self._report_regions is None:
+            account_id = self.get_account_id()
+            regions = self.get_all_regions()
+            states = {region: self.catalog.state(account_id, region) for region in regions}
+            probed = [region for region in regions if states[region] == 'unknown']
+            with self.trace.phase('probe_regions'):
+                with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(probed)))) as executor:
+                    found = dict(zip(probed, executor.map(self._probe_region, probed)))
+            for region, instances in found.items():
+                self.catalog.update(account_id, region, instances)
+            self._report_regions = [region for region in regions if states[region] == 'active' or found.get(region)]
+            logging.info('Scanning {0} of {1} regions, {2} probed, {3} skipped as empty'.format(
+                len(self._report_regions), len(regions), len(probed),
+                len([region for region in regions if states[region] == 'empty'])))
+        return self._report_regions
+
+    # Check if region has any instance with one small call
+    def _probe_region(self, region):
+        response = self._client('ec2', region).describe_instances(MaxResults=REGION_PROBE_SIZE)
+        return len(response['Reservations']) > 0 or 'NextToken' in response
+
+    # Client of the profile, shared by all workers
+    def _client(self, service, region):
+        return self.clients.get(service, region, self.profile)
+
+    # Account id of the profile, asked once per run
+    def get_account_id(self):
+        if self._account_id is None:
+            self._account_id = self._client('sts', 'us-east-1').get_caller_identity().get('Account')
+        return self._account_id
+
+    # Get filtered data about all EC2 instances, from cache if it is fresh
+    def get_ec2_prices_common(self):
+        return self.price_cache.get('AmazonEC2', EC2_PRICE_FILTERS, self._fetch_ec2_prices)
+
+    # Get filtered data about all EBS, from cache if it is fresh
+    def get_ebs_prices_common(self):
+        return self.price_cache.get('AmazonEC2', EBS_PRICE_FILTERS, self._fetch_ebs_prices)
 
     # Get filtered data about all EC2 instances from AWS pricing
-    @staticmethod
-    def get_ec2_prices_common():
-        pricing_client = boto3.client('pricing', region_name='us-east-1')
+    def _fetch_ec2_prices(self):
+        pricing_client = self._client('pricing', 'us-east-1')
         paginator = pricing_client.get_paginator('get_products')
 
         response_iterator = paginator.paginate(
             ServiceCode="AmazonEC2",
-            Filters=[
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'operatingSystem',
-                    'Value': 'Linux'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'location',
-                    'Value': 'US East (N. Virginia)'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'tenancy',
-                    'Value': 'Shared'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'preInstalledSw',
-                    'Value': 'NA'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'capacitystatus',
-                    'Value': 'Used'
-                }
-            ],
+            Filters=EC2_PRICE_FILTERS,
             PaginationConfig={
                 'PageSize': 100
             }
@@ -90,24 +1140,12 @@ class GetReports(object):
         return products
 
     # Get filtered data about all EBS from AWS pricing
-    @staticmethod
-    def get_ebs_prices_common():
-        pricing_client = boto3.client('pricing', region_name='us-east-1')
+    def _fetch_ebs_prices(self):
+        pricing_client = self._client('pricing', 'us-east-1')
         paginator = pricing_client.get_paginator('get_products')
         response_iterator = paginator.paginate(
             ServiceCode="AmazonEC2",
-            Filters=[
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'productFamily',
-                    'Value': 'Storage'
-                },
-                {
-                    'Type': 'TERM_MATCH',
-                    'Field': 'location',
-                    'Value': 'US East (N. Virginia)'
-                }
-            ]
+            Filters=EBS_PRICE_FILTERS
         )
         products = []
         volume_price = 0
@@ -126,282 +1164,924 @@ class GetReports(object):
 
         return products
 
-    # Get all existing volumes with price calculation
-    def all_existing_volumes(self):
-        ebs_prices = self.get_ebs_prices_common()
-        res = []
-        volume_price = 0
-        all_regions = self.get_all_regions()
-        for region in all_regions:
-            ec2 = boto3.resource('ec2', region)
-            all_volumes = ec2.volumes.all()
-            for volume in all_volumes:
-                for item in ebs_prices:
-                    if item['volume_type'] == volume.volume_type:
-                        if item['volume_type'] == 'io1':
-                            volume_price = (item['volume_price'] * volume.size) + (0.065 * volume.iops)
-                        else:
-                            volume_price = (item['volume_price'] * volume.size)
-                res.append({'volume_id': volume.id, 'volume_iops': volume.iops, 'volume_size': volume.size,
-                            'volume_type': volume.volume_type, 'volume_price_per_month': volume_price})
+    # Turn pricing products into a lookup, the last product of a key wins like it did in the pricing loops
+    @staticmethod
+    def _index_prices(products, key, value):
+        return {key(item): float(item[value]) for item in products}
+
+    # Price of one volume per month
+    @staticmethod
+    def _get_volume_price(ebs_price_index, volume_type, size, iops):
+        if volume_type not in ebs_price_index:
+            return 0
+        if volume_type == 'io1':
+            return (ebs_price_index[volume_type] * size) + (0.065 * iops)
+        return ebs_price_index[volume_type] * size
+
+    # Get volumes of one region with price calculation, keyed by volume id.
+    # With volume_ids only these volumes are described, in batches filtered by id
+    def _get_region_volumes(self, ec2_client, ebs_price_index, volume_ids=None):
+        with self.trace.phase('volumes'):
+            return self._describe_volumes(ec2_client, ebs_price_index, volume_ids)
+
+    # Describe volumes and calculate their prices
+    def _describe_volumes(self, ec2_client, ebs_price_index, volume_ids=None):
+        if volume_ids is None:
+            pages = ec2_client.get_paginator('describe_volumes').paginate()
+        else:
+            volume_ids = sorted(set(volume_ids))
+            pages = (ec2_client.describe_volumes(
+                Filters=[{'Name': 'volume-id', 'Values': volume_ids[i:i + FILTER_BATCH_SIZE]}])
+                for i in range(0, len(volume_ids), FILTER_BATCH_SIZE))
+
+        res = {}
+        for page in pages:
+            for volume in page['Volumes']:
+                iops = volume.get('Iops', 0)
+                res[volume['VolumeId']] = {'volume_id': volume['VolumeId'], 'volume_iops': iops,
+                                           'volume_size': volume['Size'], 'volume_type': volume['VolumeType'],
+                                           'volume_price_per_month': self._get_volume_price(
+                                               ebs_price_index, volume['VolumeType'], volume['Size'], iops)}
         return res
 
-    # Return instances from all regions
-    def get_all_instances(self):
-        ec2_prices = self.get_ec2_prices_common()
-        all_volumes = self.all_existing_volumes()
-        res = []
-        all_regions = self.get_all_regions()
-        for region in all_regions:
-            ec2_client = boto3.client("ec2", region)
-            for group in ec2_client.describe_instances()['Reservations']:
-                for instance in group['Instances']:
-                    volumes_price = 0
-                    instance_price = 0
-
-                    # Calculating instance price
-                    for item in ec2_prices:
-                        if item['instance_type'].encode('utf-8') == instance['InstanceType'].encode('utf-8'):
-                            instance_price = round(float(item['instance_price']) * float(24) * float(30.5), 2)
-
-                    # Calculating volume price
-                    block_devices_details = []
-                    for attached_disk in instance['BlockDeviceMappings']:
-                        attached_disk_id = attached_disk['Ebs']['VolumeId']
-                        for disk in all_volumes:
-                            if attached_disk_id == disk['volume_id']:
-                                volumes_price += disk['volume_price_per_month']
-                                block_devices_details.append(disk)
-
-                    summary = volumes_price + instance_price
-
-                    res.append({
-                        'Tags': instance['Tags'],
-                        'InstanceId': instance['InstanceId'],
-                        'PublicIp': instance['PublicIpAddress'] if 'PublicIpAddress' in instance else '',
-                        'PrivateIp': instance['PrivateIpAddress'] if 'PrivateIpAddress' in instance else '',
-                        'State': instance['State']['Name'],
-                        'InstanceType': instance['InstanceType'],
-                        'Region': region,
-                        'LaunchTime': instance['LaunchTime'],
-                        # 'BlockDevices': [device['Ebs']['VolumeId'] for device in instance['BlockDeviceMappings']],
-                        'BlockDevicesDetails': block_devices_details,
-                        'Price': {'instance_price_per_month': instance_price,
-                                  'volumes_price_per_month': round(volumes_price, 4),
-                                  'summary': round(summary, 4)
-                                  }
-                    })
+    # Price lookups of region, from price index when it is given and has the region, otherwise pricing API
+    # lookups of US East (N. Virginia) are built on first use, so a region or department without instances
+    # costs no pricing work. Reports of several accounts share lookups of one of them
+    def _get_price_indexes(self, region):
+        if self.prices is not None:
+            return self.prices._get_price_indexes(region)
+        if self.price_index is not None:
+            price_indexes = self.price_index.region_prices(region)
+            if price_indexes is not None:
+                return price_indexes
+        with self._prices_lock:
+            if self._price_indexes is None:
+                with self.trace.phase('pricing'):
+                    self._price_indexes = (
+                        self._index_prices(self.get_ec2_prices_common(),
+                                           lambda item: (item['instance_type'], 'Linux', 'Shared'), 'instance_price'),
+                        self._index_prices(self.get_ebs_prices_common(),
+                                           lambda item: item['volume_type'], 'volume_price'))
+        return self._price_indexes
+
+    # Filter for describe_instances, department is matched by AWS
+    @staticmethod
+    def _instance_filters(department=None):
+        if department is None:
+            return []
+        return [{'Name': 'tag:Department', 'Values': [department]}]
+
+    # Run generator func for every region in parallel and yield its items in the order of regions
+    def _stream_regions(self, func, regions=None):
+        return stream_parallel(self.get_all_regions() if regions is None else regions, func, self.workers)
+
+    # Yield instances of one region page by page, every page is priced with its attached volumes.
+    # Time of region does not include waiting for the report to take instances
+    def _iter_region_instances(self, region, department=None):
+        start_time = time.time()
+        busy = 0
+        found = 0
+        try:
+            ec2_client = self._client("ec2", region)
+            paginator = ec2_client.get_paginator('describe_instances')
+            region_volumes = None
+            for page in paginator.paginate(Filters=self._instance_filters(department)):
+                instances = [instance for group in page['Reservations'] for instance in group['Instances']]
+                if len(instances) == 0:
+                    continue
+                ec2_price_index, ebs_price_index = self._get_price_indexes(region)
 
-        return res
+                if self.volumes == 'attached':
+                    attached_ids = [device['Ebs']['VolumeId'] for instance in instances
+                                    for device in instance['BlockDeviceMappings'] if 'Ebs' in device]
+                    all_volumes = self._get_region_volumes(ec2_client, ebs_price_index, attached_ids)
+                else:
+                    if region_volumes is None:
+                        region_volumes = self._get_region_volumes(ec2_client, ebs_price_index)
+                    all_volumes = region_volumes
+
+                priced = self._price_instances(region, instances, ec2_price_index, all_volumes)
+                self.trace.count('instances', len(priced))
+                found += len(priced)
+                busy += time.time() - start_time
+                for instance in priced:
+                    yield instance
+                start_time = time.time()
+            busy += time.time() - start_time
+            # Only a scan without department filter can tell that region is empty
+            if department is None or found > 0:
+                self.catalog.update(self.get_account_id(), region, found > 0)
+        finally:
+            self.trace.add_region(region, busy)
+
+    # Key of instance in price index lookups: type, operating system and tenancy
+    @staticmethod
+    def _price_key(instance):
+        platform = instance.get('PlatformDetails') or ('Windows' if instance.get('Platform') == 'windows'
+                                                       else 'Linux/UNIX')
+        return (instance['InstanceType'], PRICE_OPERATING_SYSTEMS.get(platform),
+                PRICE_TENANCIES.get(instance.get('Placement', {}).get('Tenancy', 'default')))
 
-    # Return instances for specific department
-    def get_instances_per_department(self, department):
-        all_instances = self.get_all_instances()
+    # Add price and block devices details to instances of one region
+    @staticmethod
+    def _price_instances(region, instances, ec2_price_index, all_volumes):
         res = []
-        for instance in all_instances:
-            for tag in instance['Tags']:
-                if tag['Key'] == 'Department':
-                    if tag['Value'] == department:
-                        res.append(instance)
+        for instance in instances:
+            volumes_price = 0
+            instance_price = 0
+
+            # Calculating instance price. Platforms which are not in price index, like Windows with SQL Server,
+            # are priced as Linux, tenancies which are not in it as shared. Pricing API lookups have only these
+            instance_type, operating_system, tenancy = GetReports._price_key(instance)
+            hourly_price = None
+            for key in ((instance_type, operating_system, tenancy), (instance_type, 'Linux', tenancy),
+                        (instance_type, 'Linux', 'Shared')):
+                hourly_price = ec2_price_index.get(key)
+                if hourly_price is not None:
+                    break
+            if hourly_price is not None:
+                instance_price = round(hourly_price * float(24) * float(30.5), 2)
+            else:
+                logging.info('{0} {1}: no price for {2}, compute cost is 0'.format(
+                    region, instance['InstanceId'], instance_type))
+
+            # Calculating volume price
+            block_devices_details = []
+            for attached_disk in instance['BlockDeviceMappings']:
+                if 'Ebs' not in attached_disk:
+                    continue
+                disk = all_volumes.get(attached_disk['Ebs']['VolumeId'])
+                if disk is not None:
+                    volumes_price += disk['volume_price_per_month']
+                    block_devices_details.append(disk)
+
+            summary = volumes_price + instance_price
+
+            res.append({
+                'Tags': instance.get('Tags', []),
+                'InstanceId': instance['InstanceId'],
+                'PublicIp': instance['PublicIpAddress'] if 'PublicIpAddress' in instance else '',
+                'PrivateIp': instance['PrivateIpAddress'] if 'PrivateIpAddress' in instance else '',
+                'State': instance['State']['Name'],
+                'InstanceType': instance['InstanceType'],
+                'Region': region,
+                'LaunchTime': instance['LaunchTime'],
+                # 'BlockDevices': [device['Ebs']['VolumeId'] for device in instance['BlockDeviceMappings']],
+                'BlockDevicesDetails': block_devices_details,
+                'Price': {'instance_price_per_month': instance_price,
+                          'volumes_price_per_month': round(volumes_price, 4),
+                          'summary': round(summary, 4)
+                          }
+            })
         return res
 
+    # Yield instances from all regions with instances, every region is collected by its own worker
+    def iter_instances(self, department=None):
+        return self._stream_regions(lambda region: self._iter_region_instances(region, department),
+                                    regions=self.get_report_regions())
+
+    # Return instances from all regions
+    def get_all_instances(self, department=None):
+        return list(self.iter_instances(department))
+
+    # Return instances for specific department, filtered on AWS side by Department tag
+    def get_instances_per_department(self, department):
+        return self.get_all_instances(department)
+
+    # Collecting whole regions which are stale in inventory, other regions are taken from inventory as is
+    def refresh_inventory(self, account_id):
+        with self.trace.phase('inventory_refresh'):
+            self._refresh_inventory(account_id)
+
+    # Replace regions in inventory as they are collected
+    def _refresh_inventory(self, account_id):
+        stale = self.inventory.stale_regions(account_id, self.get_report_regions())
+        logging.info('Inventory {0}: {1} of {2} regions need refresh'.format(
+            self.inventory.path, len(stale), len(self.get_report_regions())))
+        instances = self._stream_regions(self._iter_region_instances, regions=stale)
+        with contextlib.closing(instances):
+            for region, region_instances in itertools.groupby(instances, key=lambda instance: instance['Region']):
+                self.inventory.replace_region(account_id, region, region_instances)
+                stale.remove(region)
+        for region in stale:
+            self.inventory.replace_region(account_id, region, [])
+
+    # Yield instances of the report, from inventory if it is used
+    def report_instances(self, account_id, department):
+        if self.inventory is not None:
+            self.refresh_inventory(account_id)
+            return self.inventory.iter_instances(account_id, self.get_report_regions(),
+                                                 None if department == 'common' else department)
+        return self.iter_instances(None if department == 'common' else department)
+
     # Creating excel
     def get_report_excel(self, department):
-        account_id = boto3.client('sts').get_caller_identity().get('Account')
+        account_id = self.get_account_id()
         if not os.path.exists('reports'):
             os.makedirs('reports')
 
         logging.info('Gathering data for depratment - {}, it will not take more than a minute'.format(department))
-        if department != 'common':
-            all_instances = self.get_instances_per_department(department)
-            if len(all_instances) == 0:
+        with contextlib.closing(self.report_instances(account_id, department)) as instances:
+            first_instance = next(instances, None)
+            if first_instance is None and department != 'common':
                 logging.info('No instances found for department {}'.format(department))
                 exit(0)
-        else:
-            all_instances = self.get_all_instances()
+            all_instances = itertools.chain([first_instance], instances) if first_instance is not None else []
+            if self.output_format == 'xlsx':
+                self._write_report_excel(department, account_id, all_instances)
+            else:
+                self._write_report_table(department, account_id, all_instances)
+
+    # Values of one report row, tags are turned into a map once
+    @staticmethod
+    def _report_row(instance):
+        tags = {tag['Key']: tag['Value'] for tag in instance['Tags']}
+        values = {'Region': instance['Region'],
+                  'ID': instance['InstanceId'],
+                  'Type': instance['InstanceType'],
+                  'State': instance['State'],
+                  'Public IP': instance['PublicIp'],
+                  'Launch time': str(instance['LaunchTime'])[0:-6],
+                  'Compute monthly cost (USD)': instance['Price']['instance_price_per_month'],
+                  'Storage monthly cost (USD)': instance['Price']['volumes_price_per_month'],
+                  'Compute + Storage monthly cost (USD)': instance['Price']['summary'],
+                  'Block devices size (GB)': str([volume['volume_size'] for volume in
+                                                  instance['BlockDevicesDetails']])}
+        return [tags.get(tag_key, '') if tag_key is not None else values[header]
+                for header, _, _, tag_key in REPORT_COLUMNS]
+
+    # Report row as record for table files, block devices are kept with their details
+    @staticmethod
+    def report_record(instance):
+        record = dict(zip(REPORT_HEADERS, GetReports._report_row(instance)))
+        record['Block devices size (GB)'] = [volume['volume_size'] for volume in instance['BlockDevicesDetails']]
+        record['Block devices'] = instance['BlockDevicesDetails']
+        return record
 
+    # Formats of report workbook, created once per workbook
+    @staticmethod
+    def report_formats(workbook):
+        heads = {color: workbook.add_format({'bold': True, 'font_color': color, 'font_size': 16,
+                                             'bg_color': '#D8D9DC'}) for color in ('red', 'brown', 'green')}
+        return heads, workbook.add_format({'align': 'left'})
+
+    # Add report sheet with header, extra columns are added after report columns
+    @staticmethod
+    def add_report_sheet(workbook, heads, name=None, extra_columns=()):
+        worksheet = workbook.add_worksheet(name)
+        columns = [(header, width, color) for header, width, color, _ in REPORT_COLUMNS] + list(extra_columns)
+        worksheet.autofilter(0, 0, 0, len(columns) - 1)
+        for column, (header, width, color) in enumerate(columns):
+            worksheet.set_column(column, column, width)
+            worksheet.write(0, column, header, heads[color])
+        return worksheet
+
+    # Writing rows as instances come, workbook is kept in constant memory mode.
+    # Time of writing rows does not include waiting for regions
+    def _write_report_excel(self, department, account_id, all_instances):
         nested_department = department.replace(" ", "")
         workbook = xlsxwriter.Workbook(
-            'reports/AWS-report-{0}-{1}-({2}).xlsx'.format(nested_department, account_id, date))
-        worksheet = workbook.add_worksheet()
-        head_red = workbook.add_format({'bold': True, 'font_color': 'red', 'font_size': 16, 'bg_color': '#D8D9DC'})
-        head_brown = workbook.add_format({'bold': True, 'font_color': 'brown', 'font_size': 16, 'bg_color': '#D8D9DC'})
-        head_green = workbook.add_format({'bold': True, 'font_color': 'green', 'font_size': 16, 'bg_color': '#D8D9DC'})
-        alignment = workbook.add_format({'align': 'left'})
-
-        worksheet.autofilter('A1:P1')
-
-        worksheet.set_column('A:A', 10)
-        worksheet.set_column('B:B', 40)
-        worksheet.set_column('C:C', 20)
-        worksheet.set_column('D:D', 15)
-        worksheet.set_column('E:E', 10)
-        worksheet.set_column('F:F', 15)
-        worksheet.set_column('G:G', 20)
-        worksheet.set_column('H:H', 40)
-        worksheet.set_column('I:I', 20)
-        worksheet.set_column('J:J', 20)
-        worksheet.set_column('K:K', 20)
-        worksheet.set_column('L:L', 10)
-        worksheet.set_column('M:M', 20)
-        worksheet.set_column('N:N', 40)
-        worksheet.set_column('O:O', 40)
-        worksheet.set_column('P:P', 50)
-        worksheet.set_column('Q:Q', 30)
-
-        worksheet.write('A1', 'Region', head_red)
-        worksheet.write('B1', 'Instance name', head_red)
-        worksheet.write('C1', 'ID', head_red)
-        worksheet.write('D1', 'Type', head_red)
-        worksheet.write('E1', 'State', head_red)
-        worksheet.write('F1', 'Public IP', head_red)
-        worksheet.write('G1', 'Launch time', head_red)
-        worksheet.write('H1', 'Department', head_brown)
-        worksheet.write('I1', 'Team', head_brown)
-        worksheet.write('J1', 'Team Owner', head_brown)
-        worksheet.write('K1', 'Project', head_brown)
-        worksheet.write('L1', 'Finance', head_brown)
-        worksheet.write('M1', 'Environment', head_brown)
-        worksheet.write('N1', 'Compute monthly cost (USD)', head_green)
-        worksheet.write('O1', 'Storage monthly cost (USD)', head_green)
-        worksheet.write('P1', 'Compute + Storage monthly cost (USD)', head_green)
-        worksheet.write('Q1', 'Block devices size (GB)', head_red)
-
-        line = 2
+            'reports/AWS-report-{0}-{1}-({2}).xlsx'.format(nested_department, account_id, date),
+            {'constant_memory': True})
+        heads, alignment = GetReports.report_formats(workbook)
+        worksheet = GetReports.add_report_sheet(workbook, heads)
 
         logging.info('Building excel...')
+        writing = 0
+        rows = 0
+        for line, instance in enumerate(all_instances, 1):
+            start_time = time.time()
+            worksheet.write_row(line, 0, GetReports._report_row(instance), alignment)
+            writing += time.time() - start_time
+            rows = line
+        self.trace.add_phase('write_rows', writing)
+        self.trace.count('rows', rows)
+
+        with self.trace.phase('save_workbook'):
+            workbook.close()
+
+    # Writing records to csv, jsonl or parquet file as instances come
+    def _write_report_table(self, department, account_id, all_instances):
+        nested_department = department.replace(" ", "")
+        table = TABLE_WRITERS[self.output_format](
+            'reports/AWS-report-{0}-{1}-({2})'.format(nested_department, account_id, date),
+            REPORT_HEADERS + ['Block devices'])
+
+        logging.info('Building {}...'.format(self.output_format))
+        writing = 0
         for instance in all_instances:
-            worksheet.write('A{}'.format(line), instance['Region'], alignment)
-            worksheet.write('B{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Name'][0] if
-                            len([tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Name']) != 0 else '',
-                            alignment)
-            worksheet.write('C{}'.format(line), instance['InstanceId'], alignment)
-            worksheet.write('D{}'.format(line), instance['InstanceType'], alignment)
-            worksheet.write('E{}'.format(line), instance['State'], alignment)
-            worksheet.write('F{}'.format(line), instance['PublicIp'], alignment)
-            worksheet.write('G{}'.format(line), str(instance['LaunchTime'])[0:-6], alignment)
-            worksheet.write('H{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Department'][0]
-                            if len(
-                                [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Department']) != 0 else '',
-                            alignment)
-            worksheet.write('I{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Team'][0]
-                            if len([tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Team']) != 0 else '',
-                            alignment)
-            worksheet.write('J{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'TeamOwner'][0]
-                            if len(
-                                [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'TeamOwner']) != 0 else '',
-                            alignment)
-            worksheet.write('K{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Project'][0]
-                            if len([tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Project']) != 0 else '',
-                            alignment)
-            worksheet.write('L{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Finance'][0]
-                            if len([tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Finance']) != 0 else '',
-                            alignment)
-            worksheet.write('M{}'.format(line),
-                            [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Environment'][0]
-                            if len(
-                                [tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Environment']) != 0 else '',
-                            alignment)
-            worksheet.write('N{}'.format(line), instance['Price']['instance_price_per_month'], alignment)
-            worksheet.write('O{}'.format(line), instance['Price']['volumes_price_per_month'], alignment)
-            worksheet.write('P{}'.format(line), instance['Price']['summary'], alignment)
-            worksheet.write('Q{}'.format(line),
-                            str([volume['volume_size'] for volume in instance['BlockDevicesDetails']]),
-                            alignment)
-
-            line += 1
+            start_time = time.time()
+            table.write(GetReports.report_record(instance))
+            writing += time.time() - start_time
+        self.trace.add_phase('write_rows', writing)
+        self.trace.count('rows', table.rows)
+
+        with self.trace.phase('save_table'):
+            table.close()
+
+
+# Class for report flow over several accounts, every account is collected by its own worker
+class GetReportsAccounts(object):
+
+    def __init__(self, profiles, workers=DEFAULT_WORKERS, price_cache=None, volumes='attached', inventory=None,
+                 clients=None, trace=None, catalog=None, price_index=None, output_format='xlsx'):
+        self.workers = workers
+        self.output_format = output_format
+        self.trace = trace if trace is not None else RunTrace('report')
+        clients = clients if clients is not None else AwsClients(workers, trace=self.trace)
+        catalog = catalog if catalog is not None else RegionCatalog()
+        pricing = GetReports(profiles[0], workers, price_cache, volumes, inventory, clients=clients, trace=self.trace,
+                             catalog=catalog, price_index=price_index)
+        self.reports = [pricing] + [GetReports(profile, workers, price_cache, volumes, inventory, prices=pricing,
+                                               clients=clients, trace=self.trace, catalog=catalog)
+                                    for profile in profiles[1:]]
+
+    # Account ids of all profiles, a profile of an account which is already reported is skipped
+    def get_accounts(self):
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(self.reports)))) as executor:
+            account_ids = list(executor.map(lambda report: report.get_account_id(), self.reports))
+        accounts = collections.OrderedDict()
+        for report, account_id in zip(self.reports, account_ids):
+            if account_id in accounts:
+                logging.info('Profile {0} is account {1} of profile {2}, skipping it'.format(
+                    report.profile, account_id, accounts[account_id].profile))
+                continue
+            accounts[account_id] = report
+        return accounts
+
+    # Excel sheet name, it can not be longer than 31 chars or contain []:*?/\
+    @staticmethod
+    def _sheet_name(profile, account_id):
+        name = re.sub(r'[\[\]:*?/\\]', '_', '{0} ({1})'.format(profile, account_id))
+        return name if len(name) <= 31 else account_id
 
-        workbook.close()
+    # Creating one excel with all accounts on the first sheet and a sheet per account
+    def get_report_excel(self, department):
+        accounts = self.get_accounts()
+        if not os.path.exists('reports'):
+            os.makedirs('reports')
+
+        logging.info('Gathering data for depratment - {0} from {1} accounts'.format(department, len(accounts)))
+        instances = stream_parallel(
+            list(accounts.keys()),
+            lambda account_id: ((account_id, instance)
+                                for instance in accounts[account_id].report_instances(account_id, department)),
+            self.workers)
+        with contextlib.closing(instances) as instances:
+            first_instance = next(instances, None)
+            if first_instance is None and department != 'common':
+                logging.info('No instances found for department {}'.format(department))
+                exit(0)
+            all_instances = itertools.chain([first_instance], instances) if first_instance is not None else []
+            if self.output_format == 'xlsx':
+                self._write_report_excel(department, accounts, all_instances)
+            else:
+                self._write_report_table(department, all_instances)
+
+    # Writing rows to the common sheet and to the sheet of the account as instances come
+    def _write_report_excel(self, department, accounts, all_instances):
+        nested_department = department.replace(" ", "")
+        workbook = xlsxwriter.Workbook(
+            'reports/AWS-report-{0}-multi-account-({1}).xlsx'.format(nested_department, date),
+            {'constant_memory': True})
+        heads, alignment = GetReports.report_formats(workbook)
+        common = GetReports.add_report_sheet(workbook, heads, 'All accounts', [('Account', 20, 'red')])
+        sheets = {}
+        for account_id, report in accounts.items():
+            sheets[account_id] = GetReports.add_report_sheet(workbook, heads,
+                                                             self._sheet_name(report.profile, account_id))
+        lines = collections.Counter()
+
+        logging.info('Building excel...')
+        writing = 0
+        for line, (account_id, instance) in enumerate(all_instances, 1):
+            start_time = time.time()
+            row = GetReports._report_row(instance)
+            common.write_row(line, 0, row + [account_id], alignment)
+            lines[account_id] += 1
+            sheets[account_id].write_row(lines[account_id], 0, row, alignment)
+            writing += time.time() - start_time
+        self.trace.add_phase('write_rows', writing)
+        self.trace.count('rows', sum(lines.values()))
+
+        with self.trace.phase('save_workbook'):
+            workbook.close()
+
+    # Writing records of all accounts to one csv, jsonl or parquet file with Account column
+    def _write_report_table(self, department, all_instances):
+        nested_department = department.replace(" ", "")
+        table = TABLE_WRITERS[self.output_format](
+            'reports/AWS-report-{0}-multi-account-({1})'.format(nested_department, date),
+            REPORT_HEADERS + ['Block devices', 'Account'])
+
+        logging.info('Building {}...'.format(self.output_format))
+        writing = 0
+        for account_id, instance in all_instances:
+            start_time = time.time()
+            record = GetReports.report_record(instance)
+            record['Account'] = account_id
+            table.write(record)
+            writing += time.time() - start_time
+        self.trace.add_phase('write_rows', writing)
+        self.trace.count('rows', table.rows)
+
+        with self.trace.phase('save_table'):
+            table.close()
+
+
+# Class for ingest-prices flow: reads AWS bulk offer files of EC2, json or csv, and saves prices of all regions
+# as price index. Offer files are streamed, so memory holds only products which are priced
+class IngestPrices(object):
+
+    def __init__(self, filenames, index_path=DEFAULT_PRICE_INDEX, trace=None):
+        self.filenames = filenames
+        self.index_path = index_path
+        self.trace = trace if trace is not None else RunTrace('ingest-prices')
+        self.locations = self._location_regions()
+
+    # Regions by their pricing location, for offer files without regionCode. Pricing says EU where endpoints say Europe
+    @staticmethod
+    def _location_regions():
+        locations = {}
+        for partition in botocore.loaders.create_loader().load_data('endpoints')['partitions']:
+            for region, details in partition['regions'].items():
+                locations[details['description']] = region
+                locations[details['description'].replace('Europe (', 'EU (')] = region
+        return locations
+
+    # Key of price index for product, None for products which report does not price
+    def _record_key(self, attributes):
+        region = attributes.get('regionCode') or self.locations.get(attributes.get('location'))
+        if region is None or (attributes.get('locationType') or 'AWS Region') != 'AWS Region':
+            return None
+        if attributes.get('productFamily') in ('Compute Instance', 'Compute Instance (bare metal)'):
+            if (attributes.get('preInstalledSw') or 'NA') != 'NA' or \
+                    (attributes.get('capacitystatus') or 'Used') != 'Used' or \
+                    attributes.get('licenseModel') == 'Bring your own license' or \
+                    not attributes.get('instanceType') or not attributes.get('operatingSystem'):
+                return None
+            return region, attributes['instanceType'], attributes['operatingSystem'], attributes.get('tenancy', '')
+        if attributes.get('productFamily') == 'Storage' and attributes.get('volumeApiName'):
+            return region, attributes['volumeApiName'], '', ''
+        return None
+
+    # USD price of on demand terms of product, the last price dimension wins like it does for pricing API
+    @staticmethod
+    def _on_demand_price(terms):
+        price = None
+        for term in terms.values():
+            for dimension in term['priceDimensions'].values():
+                if 'USD' in dimension['pricePerUnit']:
+                    price = float(dimension['pricePerUnit']['USD'])
+        return price
+
+    # Products of json offer come before terms, only products which are priced are kept until their terms are read
+    def _read_offer_json(self, offer):
+        reader = OfferJsonReader(offer)
+        products = {}
+        for key in reader.members():
+            if key == 'products':
+                for sku in reader.members():
+                    product = reader.value()
+                    attributes = dict(product.get('attributes', {}), productFamily=product.get('productFamily'))
+                    record_key = self._record_key(attributes)
+                    if record_key is not None:
+                        products[sku] = record_key
+            elif key == 'terms':
+                for term_type in reader.members():
+                    if term_type != 'OnDemand':
+                        reader.skip()
+                        continue
+                    for sku in reader.members():
+                        terms = reader.value()
+                        if sku in products:
+                            yield products[sku], self._on_demand_price(terms)
+            else:
+                reader.skip()
+
+    # Csv offer has a few lines about the offer before header, then every row is one price of one product
+    def _read_offer_csv(self, offer):
+        rows = csv.reader(offer)
+        for header in rows:
+            if header and header[0] == 'SKU':
+                break
+        else:
+            raise ValueError('No header with SKU column in offer file')
+        columns = dict((name, number) for number, name in enumerate(header))
+        for row in rows:
+            if row[columns['TermType']] != 'OnDemand' or row[columns['Currency']] != 'USD':
+                continue
+            record_key = self._record_key(dict((attribute, row[columns[name]])
+                                               for name, attribute in OFFER_CSV_COLUMNS.items() if name in columns))
+            if record_key is not None:
+                yield record_key, float(row[columns['PricePerUnit']])
+
+    # Read prices of one offer file, it can be gzipped
+    def _read_offer(self, filename):
+        name = filename[:-3] if filename.endswith('.gz') else filename
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt', encoding='utf-8', newline='') as offer:
+            reader = self._read_offer_csv if name.lower().endswith('.csv') else self._read_offer_json
+            for record_key, price in reader(offer):
+                yield record_key, price
+
+    def ingest(self):
+        records = {}
+        for filename in self.filenames:
+            if not os.path.exists(filename):
+                logging.info('Offer file {} does not exist'.format(filename))
+                exit(1)
+            logging.info('Reading offer file {}'.format(filename))
+            with self.trace.phase('read_offer'):
+                try:
+                    for record_key, price in self._read_offer(filename):
+                        if price is not None:
+                            records[record_key] = price
+                except ValueError as exception:
+                    logging.info('Can not read offer file {0} - {1}'.format(filename, exception))
+                    exit(1)
+
+        with self.trace.phase('write_index'):
+            PriceIndex.write(self.index_path, records)
+        self.trace.count('prices', len(records))
+        logging.info('Saved {0} prices of {1} regions to {2}'.format(
+            len(records), len(set(record_key[0] for record_key in records)), self.index_path))
+
+
+# One row of update_tags file
+class TagRow(collections.namedtuple('TagRow', ['region', 'instance_id', 'department', 'team', 'team_owner',
+                                               'project', 'finance', 'environment'])):
+    __slots__ = ()
+
+    # Tags in the order they are written to EC2
+    @property
+    def tags(self):
+        return (('Department', self.department), ('TeamOwner', self.team_owner), ('Project', self.project),
+                ('Finance', self.finance), ('Team', self.team), ('Environment', self.environment))
 
 
 # Class for update_tags flow
 class UpdateTags(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, profile=None, workers=DEFAULT_WORKERS, dry_run=False, stream=False,
+                 inventory=None, clients=None, trace=None):
         self.filename = filename
+        self.profile = profile
+        self.workers = workers
+        self.trace = trace if trace is not None else RunTrace('update_tags')
+        self.clients = clients if clients is not None else AwsClients(workers, trace=self.trace)
+        self.dry_run = dry_run
+        self.stream = stream
+        self.inventory = inventory
+        if not os.path.isfile(self.filename or ''):
+            logging.info('File {} does not exist'.format(self.filename))
+            exit(1)
+
+    # Cell value as tag text, whole numbers from excel come as floats
+    @staticmethod
+    def _cell_text(value):
+        if isinstance(value, float):
+            return str(int(value)) if value.is_integer() else str(value)
+        return value if isinstance(value, str) else str(value)
+
+    # Column number from cell reference, C5 -> 2
+    @staticmethod
+    def _column_index(reference):
+        column = 0
+        for char in reference:
+            if not char.isalpha():
+                break
+            column = column * 26 + ord(char.upper()) - ord('A') + 1
+        return column - 1
+
+    # Path of the first sheet inside xlsx
+    @staticmethod
+    def _first_sheet_path(book):
+        workbook = ElementTree.fromstring(book.read('xl/workbook.xml'))
+        relation_id = workbook.find('{0}sheets/{0}sheet'.format(XLSX_NS)).get(XLSX_REL_NS + 'id')
+        relations = ElementTree.fromstring(book.read('xl/_rels/workbook.xml.rels'))
+        for relation in relations:
+            if relation.get('Id') == relation_id:
+                target = relation.get('Target')
+                return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+        return 'xl/worksheets/sheet1.xml'
+
+    # Text of shared or inline string, plain or in rich text runs. Phonetic runs are not part of the value
+    @staticmethod
+    def _xlsx_text(element):
+        if element is None:
+            return ''
+        texts = []
+        for child in element:
+            if child.tag == XLSX_NS + 'r':
+                child = child.find(XLSX_NS + 't')
+            elif child.tag != XLSX_NS + 't':
+                continue
+            if child is not None and child.text:
+                texts.append(child.text)
+        return ''.join(texts)
+
+    # Value of one xlsx cell
+    @staticmethod
+    def _xlsx_cell_value(cell, shared_strings):
+        cell_type = cell.get('t')
+        if cell_type == 'inlineStr':
+            return UpdateTags._xlsx_text(cell.find(XLSX_NS + 'is'))
+        value = cell.find(XLSX_NS + 'v')
+        if value is None or value.text is None:
+            return ''
+        if cell_type == 's':
+            return shared_strings[int(value.text)]
+        if cell_type in ('str', 'b', 'e'):
+            return value.text
+        return float(value.text)
+
+    # Yield rows of the first sheet of xlsx one by one, without loading the whole workbook
+    def _read_xlsx_rows(self):
+        with zipfile.ZipFile(self.filename) as book:
+            shared_strings = []
+            if 'xl/sharedStrings.xml' in book.namelist():
+                with book.open('xl/sharedStrings.xml') as strings:
+                    for _, element in ElementTree.iterparse(strings):
+                        if element.tag == XLSX_NS + 'si':
+                            shared_strings.append(self._xlsx_text(element))
+                            element.clear()
+
+            with book.open(self._first_sheet_path(book)) as sheet:
+                for _, element in ElementTree.iterparse(sheet):
+                    if element.tag != XLSX_NS + 'row':
+                        continue
+                    values = []
+                    for cell in element.iter(XLSX_NS + 'c'):
+                        column = self._column_index(cell.get('r', '')) if cell.get('r') else len(values)
+                        values.extend([''] * (column - len(values)))
+                        values.append(self._xlsx_cell_value(cell, shared_strings))
+                    element.clear()
+                    yield values
+
+    # Yield rows of the first sheet with xlrd, each row is read once
+    def _read_xlrd_rows(self):
+        book = xlrd.open_workbook(self.filename, on_demand=True)
+        first_sheet = book.sheet_by_index(0)
+        for line_number in range(first_sheet.nrows):
+            yield first_sheet.row_values(line_number)
+
+    # Yield rows of csv or tsv file
+    def _read_csv_rows(self, delimiter):
+        with open(self.filename, newline='') as csv_file:
+            for values in csv.reader(csv_file, delimiter=delimiter):
+                yield values
+
+    # Parsing file, yields one TagRow per line, header is skipped
+    def read_rows(self):
+        extension = os.path.splitext(self.filename)[1].lower()
+        if extension == '.csv':
+            rows = self._read_csv_rows(',')
+        elif extension in ('.tsv', '.tab'):
+            rows = self._read_csv_rows('\t')
+        elif extension in ('.xlsx', '.xlsm') and self.stream:
+            rows = self._read_xlsx_rows()
+        else:
+            rows = self._read_xlrd_rows()
+
         try:
-            book = xlrd.open_workbook(self.filename)
-            self.first_sheet = book.sheet_by_index(0)
+            next(rows, None)
+            for values in rows:
+                values = values + [''] * (len(REPORT_COLUMNS) - len(values))
+                row = TagRow._make(self._cell_text(values[column]) for column in TAG_ROW_COLUMNS)
+                if row.instance_id == '':
+                    continue
+                yield row
         except Exception as exception:
             logging.info(exception)
             exit(1)
 
-    # Parsing excel
-    def _parse_excel(self, line_number, column_number):
-        instance_id = self.first_sheet.cell(line_number, 2)
-        tag_value = self.first_sheet.cell(line_number, column_number)
-        result = {'instance-id': instance_id, 'tag': tag_value}
-        return result
+    # Adding the same tags to a batch of EC2 instances with one call
+    def _add_tags_to_ec2(self, ec2_client, instance_ids, tags):
+        with self.trace.phase('create_tags'):
+            ec2_client.create_tags(Resources=instance_ids,
+                                   Tags=[{'Key': key, 'Value': value} for key, value in tags])
+        self.trace.count('instances_tagged', len(instance_ids))
 
-    # Adding updated tags to EC2
+    # Current values of report tags for instances of one region, described in batches filtered by id
+    def _get_current_tags(self, ec2_client, instance_ids):
+        with self.trace.phase('describe_tags'):
+            return self._describe_tags(ec2_client, instance_ids)
+
+    # Describe report tags of instances
+    @staticmethod
+    def _describe_tags(ec2_client, instance_ids):
+        current = {}
+        paginator = ec2_client.get_paginator('describe_tags')
+        for i in range(0, len(instance_ids), FILTER_BATCH_SIZE):
+            for page in paginator.paginate(Filters=[
+                    {'Name': 'resource-id', 'Values': instance_ids[i:i + FILTER_BATCH_SIZE]},
+                    {'Name': 'key', 'Values': list(TAG_KEYS)}]):
+                for tag in page['Tags']:
+                    current.setdefault(tag['ResourceId'], {})[tag['Key']] = tag['Value']
+        return current
+
+    # Ids of instances which exist and are not terminated, described in batches filtered by id
+    def _get_existing_instances(self, ec2_client, instance_ids):
+        with self.trace.phase('describe_instances'):
+            return self._describe_instance_ids(ec2_client, instance_ids)
+
+    # Describe ids of instances, filter does not fail on unknown ids like InstanceIds does
     @staticmethod
-    def _add_tag_to_ec2(region, instance_id, tag_department, tag_team, tag_team_owner, tag_project, tag_finance,
-                        tag_environment):
+    def _describe_instance_ids(ec2_client, instance_ids):
+        existing = set()
+        paginator = ec2_client.get_paginator('describe_instances')
+        for i in range(0, len(instance_ids), FILTER_BATCH_SIZE):
+            for page in paginator.paginate(Filters=[
+                    {'Name': 'instance-id', 'Values': instance_ids[i:i + FILTER_BATCH_SIZE]},
+                    {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping',
+                                                               'stopped']}]):
+                for reservation in page['Reservations']:
+                    existing.update(instance['InstanceId'] for instance in reservation['Instances'])
+        return existing
+
+    # Compare tags of one region with their current values and write only changed keys.
+    # Returns the plan of changes as (region, instance id, key, current value, new value),
+    # current value is None when the tag is not set, and ids of instances whose batch failed
+    def _update_region_tags(self, region, rows):
+        start_time = time.time()
         try:
-            ec2 = boto3.client('ec2', region)
-            ec2.create_tags(Resources=[instance_id], Tags=[{'Key': 'Department', 'Value': tag_department},
-                                                           {'Key': 'TeamOwner', 'Value': tag_team_owner},
-                                                           {'Key': 'Project', 'Value': tag_project},
-                                                           {'Key': 'Finance', 'Value': tag_finance},
-                                                           {'Key': 'Team', 'Value': tag_team},
-                                                           {'Key': 'Environment', 'Value': tag_environment},
-                                                           ])
+            return self._tag_region(region, rows)
+        finally:
+            self.trace.add_region(region, time.time() - start_time)
+
+    # Tagging of one region. Unknown or terminated instances are skipped, AWS fails the whole batch for one of them
+    def _tag_region(self, region, rows):
+        ec2_client = self.clients.get('ec2', region, self.profile)
+        existing = self._get_existing_instances(ec2_client, sorted(rows))
+        for instance_id in [instance_id for instance_id in rows if instance_id not in existing]:
+            logging.info('{0} {1}: instance not found, skipped'.format(region, instance_id))
+            self.trace.count('instances_not_found')
+        rows = collections.OrderedDict((instance_id, tags) for instance_id, tags in rows.items()
+                                       if instance_id in existing)
+        current = self._get_current_tags(ec2_client, sorted(rows))
+
+        plan = []
+        batches = collections.OrderedDict()
+        for instance_id, tags in rows.items():
+            instance_tags = current.get(instance_id, {})
+            changed = tuple((key, value) for key, value in tags if instance_tags.get(key) != value)
+            if len(changed) == 0:
+                continue
+            plan.extend((region, instance_id, key, instance_tags.get(key), value) for key, value in changed)
+            batches.setdefault(changed, []).append(instance_id)
+
+        logging.info('{0}: {1} of {2} instances need new tags'.format(
+            region, sum(len(instance_ids) for instance_ids in batches.values()), len(rows)))
+        if self.dry_run:
+            return plan, []
+
+        # Batches of region are written concurrently, rate controller keeps them under rate of the region
+        jobs = [(tags, instance_ids[i:i + TAG_BATCH_SIZE]) for tags, instance_ids in batches.items()
+                for i in range(0, len(instance_ids), TAG_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(jobs)))) as executor:
+            failed = list(itertools.chain.from_iterable(
+                executor.map(lambda job: self._tag_batch(ec2_client, region, *job), jobs)))
+        return plan, failed
+
+    # Tagging of one batch, instances of failed batch are returned
+    def _tag_batch(self, ec2_client, region, tags, batch):
+        logging.info('Tagging {0} instances in {1} with: {2}'.format(
+            len(batch), region, ', '.join('{0}={1}'.format(key, value) for key, value in tags)))
+        try:
+            self._add_tags_to_ec2(ec2_client, batch, tags)
+            return []
         except Exception as exception:
-            logging.info(exception)
-            exit(1)
+            logging.info('{0}: tagging of {1} instances failed, {2}'.format(region, len(batch), exception))
+            return batch
 
-    # Update tags from provided file
+    # Writing plan of tag changes to csv
+    @staticmethod
+    def _write_plan(plan):
+        if not os.path.exists('reports'):
+            os.makedirs('reports')
+        path = 'reports/AWS-tags-plan-({}).csv'.format(date)
+        with open(path, 'w') as plan_file:
+            writer = csv.writer(plan_file)
+            writer.writerow(['Region', 'ID', 'Tag', 'Current value', 'New value'])
+            writer.writerows(plan)
+        logging.info('Plan of {0} tag changes saved to {1}'.format(len(plan), path))
+
+    # Removing instances which are not in inventory of their region before anything is described for them
+    def _skip_unknown_instances(self, regions):
+        account_id = self.clients.get('sts', 'us-east-1', self.profile).get_caller_identity().get('Account')
+        for region, rows in regions.items():
+            known = self.inventory.region_instance_ids(account_id, region)
+            if known is None:
+                continue
+            for instance_id in [instance_id for instance_id in rows if instance_id not in known]:
+                logging.info('{0} {1}: not found in inventory, skipped'.format(region, instance_id))
+                del rows[instance_id]
+
+    # Update tags from provided file, only tags which differ from current ones are written
     def update_tags(self):
-        number_of_lines = int(self.first_sheet.nrows)
-
-        for line_number in range(1, number_of_lines):
-            region = self._parse_excel(line_number, 0)['tag'].value
-            instance_id = self._parse_excel(line_number, 2)['instance-id'].value
-            department = self._parse_excel(line_number, 7)['tag'].value
-            team = self._parse_excel(line_number, 8)['tag'].value
-            team_owner = self._parse_excel(line_number, 9)['tag'].value
-            project = self._parse_excel(line_number, 10)['tag'].value
-            finance = self._parse_excel(line_number, 11)['tag'].value
-            environment = self._parse_excel(line_number, 12)['tag'].value
-
-            logging.info('Modifying: {0} with new tags: {1}, {2}, {3}, {4}, {5}, {6}'.format(instance_id, department,
-                                                                                             team, team_owner, project,
-                                                                                             finance, environment))
-            try:
-                self._add_tag_to_ec2(region, instance_id, department, team, team_owner, project, finance, environment)
-            except Exception as exception:
-                logging.info(exception)
-                exit(1)
+        regions = collections.OrderedDict()
+        with self.trace.phase('read_file'):
+            for row in self.read_rows():
+                regions.setdefault(row.region, collections.OrderedDict())[row.instance_id] = row.tags
+                self.trace.count('rows')
+        if self.inventory is not None:
+            self._skip_unknown_instances(regions)
+
+        plan = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(regions)))) as executor:
+            futures = [(region, executor.submit(self._update_region_tags, region, rows))
+                       for region, rows in regions.items()]
+            for region, future in futures:
+                try:
+                    region_plan, region_failed = future.result()
+                    plan.extend(region_plan)
+                    failed.extend((region, instance_id) for instance_id in region_failed)
+                except Exception as exception:
+                    logging.info('{0}: {1}'.format(region, exception))
+                    failed.extend((region, instance_id) for instance_id in regions[region])
+        self.trace.count('tag_changes', len(plan))
+
+        for region, instance_id, key, current_value, new_value in plan:
+            logging.info('{0} {1}: {2} {3} -> "{4}"'.format(
+                region, instance_id, key, '(not set)' if current_value is None else '"{}"'.format(current_value),
+                new_value))
+        if self.dry_run:
+            self._write_plan(plan)
+        if failed:
+            self._write_failed(regions, failed)
+            exit(1)
+
+    # Writing instances which were not tagged to csv, it can be given to update_tags again
+    @staticmethod
+    def _write_failed(regions, failed):
+        if not os.path.exists('reports'):
+            os.makedirs('reports')
+        path = 'reports/AWS-tags-failed-({}).csv'.format(date)
+        with open(path, 'w') as failed_file:
+            writer = csv.writer(failed_file)
+            writer.writerow(REPORT_HEADERS)
+            for region, instance_id in failed:
+                values = dict(regions[region][instance_id], Region=region, ID=instance_id)
+                writer.writerow([values.get(tag_key if tag_key is not None else header, '')
+                                 for header, _, _, tag_key in REPORT_COLUMNS])
+        logging.info('{0} instances were not tagged, run update_tags with {1} to retry them'.format(len(failed), path))
 
 
 # Class for kubernetes reports flow
 class GetReportKubernetes(object):
-    def __init__(self):
-        config.load_kube_config()
-        self.v1 = client.CoreV1Api()
+    def __init__(self, context=None, v1=None, trace=None, output_format='xlsx'):
+        self.context = context
+        self.output_format = output_format
+        self.trace = trace if trace is not None else RunTrace('kube-report')
+        if v1 is not None:
+            self.v1 = v1
+        elif context is None:
+            config.load_kube_config()
+            self.v1 = client.CoreV1Api()
+        else:
+            self.v1 = client.CoreV1Api(config.new_client_from_config(context=context))
 
-    @staticmethod
-    def cluster_name():
+    def cluster_name(self):
+        if self.context is not None:
+            return self.context.split(".")[0]
         return config.list_kube_config_contexts()[1]['name'].split(".")[0]
 
-    def get_all_namespaces(self):
-        ret = self.v1.list_namespace()
-        namespaces = []
-        for namespace in ret.items:
-            namespaces.append(namespace.metadata.name)
-        return namespaces
-
-    def get_pod_resources(self, namespace, pod_name):
-        ret = self.v1.read_namespaced_pod(namespace=namespace, name=pod_name)
-        return ret.spec.containers[0].resources.requests
+    # All pods of the cluster with one call, indexed by namespace and name
+    def get_pod_index(self):
+        return self.index_items(self.list_pods().items)
 
-    # Price per CPU
+    # Objects indexed by namespace and name
+    @staticmethod
+    def index_items(items):
+        return {(item.metadata.namespace, item.metadata.name): item for item in items}
+
+    def list_pods(self):
+        with self.trace.phase('list_pods'):
+            pods = self.v1.list_pod_for_all_namespaces(watch=False)
+        self.trace.call('kube.list_pod_for_all_namespaces')
+        self.trace.count('pods', len(pods.items))
+        return pods
+
+    def list_endpoints(self):
+        with self.trace.phase('list_endpoints'):
+            endpoints = self.v1.list_endpoints_for_all_namespaces(watch=False)
+        self.trace.call('kube.list_endpoints_for_all_namespaces')
+        return endpoints
+
+    # Requests of every container of every pod, pods missing in index are skipped
+    @staticmethod
+    def get_pods_resources(pod_index, namespace, pod_names):
+        pods_resources = []
+        for pod_name in pod_names:
+            pod = pod_index.get((namespace, pod_name))
+            if pod is not None:
+                pods_resources.append([container.resources.requests if container.resources is not None else None
+                                       for container in pod.spec.containers])
+        return pods_resources
+
+    # Price per CPU, cpu in millicores
     @staticmethod
     def get_price_per_cpu(cpu):
         one_cpu_price = 63  # price for 1 vCPU RAM in $
@@ -409,131 +2089,348 @@ class GetReportKubernetes(object):
         price = cpu * one_cpu_price
         return round(price, 1)
 
-    # Price per RAM
+    # Price per RAM, ram in Mi
     @staticmethod
     def get_price_per_ram(ram):
         one_gb_ram_price = 16  # price for 1Gb RAM in $
-        ram = ram / 1000
+        ram = ram / 1024
         price = ram * one_gb_ram_price
         return round(price, 1)
 
+    # Endpoints and pods of all namespaces are listed once, pods are taken from index
     def structured_data(self):
-        result = []
-        for namespace in self.get_all_namespaces():
+        return self.structured_data_from(self.list_endpoints().items, self.get_pod_index())
 
-            endpoints = self.v1.list_namespaced_endpoints(watch=False, namespace=namespace)
-            for service in endpoints.items:
-                if 'headless' in service.metadata.name:
-                    continue
-                labels = service.metadata.labels
-                if labels is not None and 'owner' in labels:
-                    owner_label = labels['owner']
-                else:
-                    owner_label = 'Not set'
-                if service.subsets is not None:
-                    pod_names = []
-                    for subset in service.subsets:
-                        if subset.addresses is not None:
-                            for pod in subset.addresses:
-                                if pod.target_ref is not None:
-                                    pod_names.append(pod.target_ref.name)
-                    # pod_resources = None
-                    if len(pod_names) != 0:
-                        pod_resources = self.get_pod_resources(namespace=namespace, pod_name=pod_names[0])
-                        if pod_resources is not None:
-                            result.append([{'service-name': service.metadata.name},
-                                           {'pods': pod_names},
-                                           {'namespace': service.metadata.namespace},
-                                           {'one_pod_resource': pod_resources},
-                                           {'owner': owner_label}
-                                           ])
+    # Services with their pods from already collected endpoints and pods
+    def structured_data_from(self, endpoints, pod_index):
+        result = []
+        for service in endpoints:
+            if 'headless' in service.metadata.name:
+                continue
+            namespace = service.metadata.namespace
+            labels = service.metadata.labels
+            if labels is not None and 'owner' in labels:
+                owner_label = labels['owner']
+            else:
+                owner_label = 'Not set'
+            if service.subsets is not None:
+                pod_names = []
+                for subset in service.subsets:
+                    if subset.addresses is not None:
+                        for pod in subset.addresses:
+                            if pod.target_ref is not None:
+                                pod_names.append(pod.target_ref.name)
+                if len(pod_names) != 0:
+                    pods_resources = self.get_pods_resources(pod_index, namespace, pod_names)
+                    if any(requests is not None for requests in itertools.chain.from_iterable(pods_resources)):
+                        result.append([{'service-name': service.metadata.name},
+                                       {'pods': pod_names},
+                                       {'namespace': namespace},
+                                       {'pods_resources': pods_resources},
+                                       {'owner': owner_label}
+                                       ])
         return result
 
-    # Pretty CPU:
+    # Kubernetes quantity in base units, cores for CPU and bytes for RAM: 250m, 1.5, 512Mi, 1G, 1e3
     @staticmethod
-    def pretty_cpu(cpu):
-        if 'm' in cpu:
-            cpu = cpu[0:-1]
-        else:
-            cpu = cpu + '000'
+    def parse_quantity(quantity):
+        match = QUANTITY_PATTERN.match(str(quantity).strip())
+        if match is None:
+            raise ValueError('Not valid kubernetes quantity - {}'.format(quantity))
+        number, exponent, suffix = match.groups()
+        value = float(number + (exponent or ''))
+        return value * QUANTITY_SUFFIXES[suffix or '']
+
+    # Resources of all containers of all services as columns
+    @staticmethod
+    def aggregate(all_data):
+        resources = KubeResources()
+        for instance in all_data:
+            resources.add_service(instance[0]['service-name'], str(instance[2]['namespace']), instance[4]['owner'],
+                                  instance[1]['pods'], instance[3]['pods_resources'])
+        return resources
+
+    # Writing rows of one sheet, clusters is a list of (cluster name, rows).
+    # Cluster column is added when rows of several clusters go to one workbook
+    @staticmethod
+    def _write_sheet(workbook, name, columns, clusters, with_cluster, formats):
+        columns = ([('Cluster', 30, False)] if with_cluster else []) + columns
+        head_red, alignment, alignment_center = formats
+        worksheet = workbook.add_worksheet(name)
+
+        worksheet.autofilter(0, 0, 0, len(columns) - 1)
+        for column, (header, width, _) in enumerate(columns):
+            worksheet.set_column(column, column, width)
+            worksheet.write(0, column, header, head_red)
+
+        line = 1
+        for cluster_name, rows in clusters:
+            for row in rows:
+                if with_cluster:
+                    row = [cluster_name] + row
+                for column, value in enumerate(row):
+                    worksheet.write(line, column, value, alignment_center if columns[column][2] else alignment)
+                line += 1
+
+    # Writing services of one or more clusters with namespace and owner summaries,
+    # clusters is a list of (cluster name, KubeResources)
+    @staticmethod
+    def write_report_excel(path, clusters, with_cluster=False):
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        formats = (workbook.add_format({'bold': True, 'font_color': 'red', 'font_size': 16, 'bg_color': '#D8D9DC'}),
+                   workbook.add_format({'align': 'left'}),
+                   workbook.add_format({'align': 'center'}))
+
+        GetReportKubernetes._write_sheet(workbook, 'Services', KUBE_REPORT_COLUMNS,
+                                         [(name, resources.service_rows()) for name, resources in clusters],
+                                         with_cluster, formats)
+        for sheet_name, header, field in (('Namespaces', 'Namespace', 'namespace'), ('Owners', 'Owner', 'owner')):
+            GetReportKubernetes._write_sheet(workbook, sheet_name, [(header, 45, False)] + KUBE_SUMMARY_COLUMNS,
+                                             [(name, resources.rollup_rows(field)) for name, resources in clusters],
+                                             with_cluster, formats)
 
-        return int(cpu)
+        workbook.close()
 
-    # Pretty RAM
+    # Writing services, namespace and owner summaries of one or more clusters to csv, jsonl or parquet,
+    # one file per table. Pods of every service are kept as list column
     @staticmethod
-    def pretty_ram(ram):
-        if 'Mi' in ram:
-            ram = ram[0:-2]
-        if 'Gi' in ram:
-            ram = ram[0:-2] + '000'
+    def write_report_tables(path, clusters, output_format, with_cluster=False):
+        tables = [('services', [header for header, _, _ in KUBE_REPORT_COLUMNS] + ['Pods'],
+                   lambda resources: (row + [pods] for row, pods in zip(resources.service_rows(),
+                                                                        resources.service_pods)))]
+        for field, header in (('namespace', 'Namespace'), ('owner', 'Owner')):
+            tables.append(('{}s'.format(field), [header] + [column for column, _, _ in KUBE_SUMMARY_COLUMNS],
+                           lambda resources, field=field: resources.rollup_rows(field)))
+
+        for name, headers, rows in tables:
+            headers = (['Cluster'] if with_cluster else []) + headers
+            table = TABLE_WRITERS[output_format]('{0}-{1}'.format(path, name), headers)
+            for cluster_name, resources in clusters:
+                for row in rows(resources):
+                    table.write(dict(zip(headers, ([cluster_name] if with_cluster else []) + row)))
+            table.close()
+
+    # Writing report as xlsx or as tables, path is without extension
+    @staticmethod
+    def write_report(path, clusters, output_format='xlsx', with_cluster=False):
+        if output_format == 'xlsx':
+            GetReportKubernetes.write_report_excel('{}.xlsx'.format(path), clusters, with_cluster)
+        else:
+            GetReportKubernetes.write_report_tables(path, clusters, output_format, with_cluster)
 
-        return int(ram)
+    # Creating excel, from already collected data if it is provided
+    def get_report_excel(self, all_data=None, report_date=date):
+        if not os.path.exists('reports'):
+            os.makedirs('reports')
 
-    # Creating excel
+        logging.info('Building excel...')
+        if all_data is None:
+            all_data = self.structured_data()
+        with self.trace.phase('aggregate'):
+            resources = self.aggregate(all_data)
+        self.trace.count('services', len(all_data))
+        with self.trace.phase('write_excel'):
+            self.write_report('reports/kube-report-({0})-({1})'.format(self.cluster_name(), report_date),
+                              [(self.cluster_name(), resources)], self.output_format)
+
+
+# Resources of kubernetes services kept as columns with one entry per container of every pod,
+# totals and costs are computed for all services in one pass
+class KubeResources(object):
+
+    def __init__(self):
+        self.services = []  # (service name, namespace, owner, number of pods, number of pods with resources)
+        self.service_pods = []  # names of pods of every service
+        self.container_service = array.array('l')
+        self.container_cpu = array.array('d')  # millicores
+        self.container_ram = array.array('d')  # Mi
+
+    def add_service(self, name, namespace, owner, pods, pods_resources):
+        index = len(self.services)
+        self.services.append((name, namespace, owner, len(pods), len(pods_resources)))
+        self.service_pods.append(list(pods))
+        for requests in itertools.chain.from_iterable(pods_resources):
+            requests = requests or {}
+            self.container_service.append(index)
+            self.container_cpu.append(GetReportKubernetes.parse_quantity(requests.get('cpu', '0')) * 1000)
+            self.container_ram.append(GetReportKubernetes.parse_quantity(requests.get('memory', '0')) / 2 ** 20)
+
+    # CPU and RAM totals of every service
+    def service_totals(self):
+        total_cpu = array.array('d', [0]) * len(self.services)
+        total_ram = array.array('d', [0]) * len(self.services)
+        for service, cpu, ram in zip(self.container_service, self.container_cpu, self.container_ram):
+            total_cpu[service] += cpu
+            total_ram[service] += ram
+        return total_cpu, total_ram
+
+    # Report rows, one row per service. One pod is the average of pods found in the cluster
+    def service_rows(self):
+        total_cpu, total_ram = self.service_totals()
+        for (name, namespace, owner, pods_number, pods_found), cpu, ram in zip(self.services, total_cpu, total_ram):
+            yield [name, namespace, owner, pods_number, int(round(cpu / pods_found)), int(round(ram / pods_found)),
+                   int(round(cpu)), int(round(ram)), GetReportKubernetes.get_price_per_cpu(cpu),
+                   GetReportKubernetes.get_price_per_ram(ram)]
+
+    # Summary rows per namespace or owner
+    def rollup_rows(self, field):
+        position = {'namespace': 1, 'owner': 2}[field]
+        total_cpu, total_ram = self.service_totals()
+        rollups = collections.OrderedDict()
+        for service, cpu, ram in zip(self.services, total_cpu, total_ram):
+            rollup = rollups.setdefault(service[position], [0, 0, 0, 0])
+            rollup[0] += 1
+            rollup[1] += service[3]
+            rollup[2] += cpu
+            rollup[3] += ram
+        for key in sorted(rollups):
+            services, pods, cpu, ram = rollups[key]
+            price_per_cpu = GetReportKubernetes.get_price_per_cpu(cpu)
+            price_per_ram = GetReportKubernetes.get_price_per_ram(ram)
+            yield [key, services, pods, int(round(cpu)), int(round(ram)), price_per_cpu, price_per_ram,
+                   round(price_per_cpu + price_per_ram, 1)]
+
+
+# Class for kubernetes inventory kept up to date by watch streams.
+# Endpoints and pods are listed once like in GetReportKubernetes, then only changes are received
+class KubeInventory(object):
+
+    def __init__(self, kube_report):
+        self.kube_report = kube_report
+        self.lock = threading.Lock()
+        self.report_requested = threading.Event()
+        self.watch_failed = threading.Event()
+        self.indexes = {'endpoints': {}, 'pods': {}}
+        self.resource_versions = {}
+        self.lists = {'endpoints': kube_report.list_endpoints, 'pods': kube_report.list_pods}
+        self.watched = {'endpoints': kube_report.v1.list_endpoints_for_all_namespaces,
+                        'pods': kube_report.v1.list_pod_for_all_namespaces}
+
+    # Listing all objects of kind, also used when resource version is too old to resume
+    def _relist(self, kind):
+        ret = self.lists[kind]()
+        with self.lock:
+            self.indexes[kind] = self.kube_report.index_items(ret.items)
+            self.resource_versions[kind] = ret.metadata.resource_version
+        logging.info('Listed {0} {1}, resource version {2}'.format(len(ret.items), kind, ret.metadata.resource_version))
+
+    def bootstrap(self):
+        for kind in self.lists:
+            self._relist(kind)
+
+    # Applying watch events of kind to its index, watch is resumed from the last seen resource version.
+    # API and connection errors are retried, any other error stops kube-watch instead of leaving index stale
+    def _watch(self, kind):
+        try:
+            self._watch_events(kind)
+        except Exception:
+            logging.exception('Watch of {} stopped'.format(kind))
+            self.watch_failed.set()
+            self.report_requested.set()
+
+    def _watch_events(self, kind):
+        while True:
+            try:
+                stream = watch.Watch().stream(self.watched[kind], resource_version=self.resource_versions[kind],
+                                              timeout_seconds=KUBE_WATCH_TIMEOUT)
+                for event in stream:
+                    if event['type'] == 'ERROR':
+                        if event['raw_object'].get('code') == 410:
+                            logging.info('Resource version of {} is too old, listing again'.format(kind))
+                            self._relist(kind)
+                            break
+                        raise ApiException(status=event['raw_object'].get('code'),
+                                           reason=event['raw_object'].get('message'))
+                    item = event['object']
+                    with self.lock:
+                        self.resource_versions[kind] = item.metadata.resource_version
+                        key = (item.metadata.namespace, item.metadata.name)
+                        if event['type'] == 'DELETED':
+                            self.indexes[kind].pop(key, None)
+                        else:
+                            self.indexes[kind][key] = item
+            except ApiException as exception:
+                if exception.status == 410:
+                    self._relist(kind)
+                else:
+                    logging.info(exception)
+                    time.sleep(KUBE_WATCH_RETRY)
+            except (urllib3.exceptions.HTTPError, OSError) as exception:
+                logging.info(exception)
+                time.sleep(KUBE_WATCH_RETRY)
+
+    # Report from current index, no API calls are made
     def get_report_excel(self):
+        with self.lock:
+            endpoints = list(self.indexes['endpoints'].values())
+            pod_index = dict(self.indexes['pods'])
+        all_data = self.kube_report.structured_data_from(endpoints, pod_index)
+        self.kube_report.get_report_excel(all_data, datetime.datetime.now().strftime("%Y-%m-%d-%H-%M"))
+        logging.info('Report saved with {} services'.format(len(all_data)))
+
+    # Keep watching and produce report every interval seconds, or on SIGUSR1
+    def run(self, interval):
+        self.bootstrap()
+        for kind in self.watched:
+            threading.Thread(target=self._watch, args=(kind,), daemon=True).start()
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.report_requested.set())
+
+        while True:
+            self.get_report_excel()
+            self.report_requested.wait(interval if interval > 0 else None)
+            self.report_requested.clear()
+            if self.watch_failed.is_set():
+                exit(1)
+
+
+# Class for kubernetes reports of several clusters, every cluster is collected by its own worker
+class GetReportKubernetesClusters(object):
+
+    def __init__(self, contexts, workers=DEFAULT_WORKERS, trace=None, output_format='xlsx'):
+        self.contexts = self.get_contexts(contexts)
+        self.workers = workers
+        self.output_format = output_format
+        self.trace = trace if trace is not None else RunTrace('kube-report')
+
+    # Context names from comma separated list, all means every context of kubeconfig
+    @staticmethod
+    def get_contexts(contexts):
+        if contexts == 'all':
+            return [context['name'] for context in config.list_kube_config_contexts()[0]]
+        return [context.strip() for context in contexts.split(',') if context.strip()]
+
+    # Resources of one cluster, time of cluster is traced like time of region
+    def _collect(self, context):
+        start_time = time.time()
+        kube_report = GetReportKubernetes(context, trace=self.trace)
+        logging.info('Collecting cluster {}'.format(kube_report.cluster_name()))
+        all_data = kube_report.structured_data()
+        with self.trace.phase('aggregate'):
+            resources = kube_report.aggregate(all_data)
+        self.trace.count('services', len(all_data))
+        self.trace.add_region(kube_report.cluster_name(), time.time() - start_time)
+        return kube_report.cluster_name(), resources
+
+    # Creating one excel with Cluster column or one excel per cluster
+    def get_report_excel(self, split=False):
         if not os.path.exists('reports'):
             os.makedirs('reports')
 
-        workbook = xlsxwriter.Workbook(
-            'reports/kube-report-({0})-({1}).xlsx'.format(self.cluster_name(), date))
-        worksheet = workbook.add_worksheet()
-        head_red = workbook.add_format({'bold': True, 'font_color': 'red', 'font_size': 16, 'bg_color': '#D8D9DC'})
-
-        alignment = workbook.add_format({'align': 'left'})
-        alignment_center = workbook.add_format({'align': 'center'})
-
-        worksheet.autofilter('A1:J1')
-
-        worksheet.set_column('A:A', 45)
-        worksheet.set_column('B:B', 30)
-        worksheet.set_column('C:C', 10)
-        worksheet.set_column('D:D', 15)
-        worksheet.set_column('E:E', 15)
-        worksheet.set_column('F:F', 15)
-        worksheet.set_column('G:G', 20)
-        worksheet.set_column('H:H', 20)
-        worksheet.set_column('I:I', 25)
-        worksheet.set_column('J:J', 25)
-
-        worksheet.write('A1', 'Service Name', head_red)
-        worksheet.write('B1', 'Namespace', head_red)
-        worksheet.write('C1', 'Owner', head_red)
-        worksheet.write('D1', 'Number of pods', head_red)
-        worksheet.write('E1', 'CPU (one pod)', head_red)
-        worksheet.write('F1', 'RAM (one pod)', head_red)
-        worksheet.write('G1', 'CPU (total)', head_red)
-        worksheet.write('H1', 'RAM (total)', head_red)
-        worksheet.write('I1', 'Price per CPU (USD)', head_red)
-        worksheet.write('J1', 'Price per RAM (USD)', head_red)
-
-        line = 2
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(self.contexts)))) as executor:
+            clusters = list(executor.map(self._collect, self.contexts))
 
         logging.info('Building excel...')
-        all_data = self.structured_data()
-        for instance in all_data:
-            pod_number = len(instance[1]['pods'])
-            cpu = self.pretty_cpu(instance[3]['one_pod_resource']['cpu'])
-            ram = self.pretty_ram(instance[3]['one_pod_resource']['memory'])
-            total_cpu = pod_number * cpu
-            total_ram = pod_number * ram
-            owner = instance[4]['owner']
-            price_per_cpu = self.get_price_per_cpu(total_cpu)
-            price_per_ram = self.get_price_per_ram(total_ram)
-
-            worksheet.write('A{}'.format(line), instance[0]['service-name'], alignment)
-            worksheet.write('B{}'.format(line), str(instance[2]['namespace']), alignment)
-            worksheet.write('C{}'.format(line), owner, alignment_center)
-            worksheet.write('D{}'.format(line), pod_number, alignment_center)
-            worksheet.write('E{}'.format(line), cpu, alignment)
-            worksheet.write('F{}'.format(line), ram, alignment)
-            worksheet.write('G{}'.format(line), total_cpu, alignment)
-            worksheet.write('H{}'.format(line), total_ram, alignment)
-            worksheet.write('I{}'.format(line), price_per_cpu, alignment_center)
-            worksheet.write('J{}'.format(line), price_per_ram, alignment_center)
-
-            line += 1
-
-        workbook.close()
+        with self.trace.phase('write_excel'):
+            if split:
+                for cluster_name, rows in clusters:
+                    GetReportKubernetes.write_report(
+                        'reports/kube-report-({0})-({1})'.format(cluster_name, date), [(cluster_name, rows)],
+                        self.output_format)
+            else:
+                GetReportKubernetes.write_report(
+                    'reports/kube-report-(all-clusters)-({})'.format(date), clusters, self.output_format,
+                    with_cluster=True)
 
 
 # Main
@@ -546,9 +2443,108 @@ class GetReportKubernetes(object):
 )
 @click.option(
     '-f', '--filename',
-    help='Provide name of file for parsing new tags',
+    help='Provide name of file for parsing new tags, could be .xlsx, .xls, .csv or .tsv. '
+         'For ingest-prices AWS bulk offer files of EC2, comma separated, could be .json or .csv, also gzipped',
+)
+@click.option(
+    '-w', '--workers', default=DEFAULT_WORKERS, type=click.IntRange(min=1),
+    help='Number of regions or clusters handled in parallel, by default it will be {}'.format(DEFAULT_WORKERS),
+)
+@click.option(
+    '--price-cache-ttl', default=DEFAULT_PRICE_CACHE_TTL, type=click.FloatRange(min=0),
+    help='Hours before cached AWS prices are fetched again, by default it will be {}'.format(DEFAULT_PRICE_CACHE_TTL),
+)
+@click.option(
+    '--refresh-prices', is_flag=True,
+    help='Fetch AWS prices even if cached prices are fresh',
+)
+@click.option(
+    '--offline-prices', is_flag=True,
+    help='Use only cached AWS prices, never call AWS pricing',
+)
+@click.option(
+    '--price-index',
+    help='Price index built by ingest-prices, report prices every region by it, by default it will be {} '
+         'for ingest-prices and US East (N. Virginia) prices of AWS pricing for report'.format(DEFAULT_PRICE_INDEX),
+)
+@click.option(
+    '--volumes', default='attached', type=click.Choice(['attached', 'all']),
+    help='Describe only volumes attached to reported instances or all volumes, by default it will be attached',
+)
+@click.option(
+    '--stream', is_flag=True,
+    help='Read .xlsx file for update_tags row by row, for very large sheets',
+)
+@click.option(
+    '--dry-run', is_flag=True,
+    help='Only show and save plan of tag changes for update_tags, nothing is written',
+)
+@click.option(
+    '-c', '--contexts',
+    help='Kubeconfig contexts for kube-report, comma separated or all, by default only current context',
+)
+@click.option(
+    '--split-clusters', is_flag=True,
+    help='Save kube-report of every context to its own file instead of one file with Cluster column',
+)
+@click.option(
+    '--interval', default=DEFAULT_KUBE_REPORT_INTERVAL, type=click.IntRange(min=0),
+    help='Seconds between reports of kube-watch, 0 means only on SIGUSR1, by default it will be {}'.format(
+        DEFAULT_KUBE_REPORT_INTERVAL),
+)
+@click.option(
+    '--describe-rate', default=DEFAULT_DESCRIBE_RATE, type=click.FloatRange(min=RATE_MIN),
+    help='Describe calls per second per region to start with, it grows while AWS does not throttle, '
+         'by default it will be {}'.format(DEFAULT_DESCRIBE_RATE),
+)
+@click.option(
+    '--mutate-rate', default=DEFAULT_MUTATE_RATE, type=click.FloatRange(min=RATE_MIN),
+    help='Mutating calls like create_tags per second per region to start with, it grows while AWS does not throttle, '
+         'by default it will be {}'.format(DEFAULT_MUTATE_RATE),
 )
-def main(profile, flow, filename, department='common'):
+@click.option(
+    '--trace', 'trace_file',
+    help='Save trace of the run as json: phases, regions, API calls, retries, throttles and processed rows',
+)
+@click.option(
+    '--metrics', 'metrics_file',
+    help='Save trace of the run as Prometheus textfile, for node exporter textfile collector',
+)
+@click.option(
+    '--accounts-file',
+    help='Ini file with an account per section for report, profile of section is its name unless profile is set',
+)
+@click.option(
+    '--regions', 'include_regions',
+    help='Regions for report, comma separated, patterns like eu-* work, by default all enabled regions',
+)
+@click.option(
+    '--exclude-regions',
+    help='Regions skipped by report, comma separated, patterns like ap-* work',
+)
+@click.option(
+    '--empty-region-skip', default=DEFAULT_EMPTY_REGION_SKIP, type=click.FloatRange(min=0),
+    help='Hours to skip regions which had no instances, 0 means they are probed with one small call, '
+         'by default it will be {}'.format(DEFAULT_EMPTY_REGION_SKIP),
+)
+@click.option(
+    '--output-format', default='xlsx', type=click.Choice(OUTPUT_FORMATS),
+    help='Format of report and kube-report files, csv, jsonl and parquet are for loading reports in bulk, '
+         'parquet needs pyarrow, by default it will be xlsx',
+)
+@click.option(
+    '--inventory',
+    help='SQLite file with EC2 inventory, report refreshes only stale regions and update_tags checks ids in it',
+)
+@click.option(
+    '--inventory-ttl', default=DEFAULT_INVENTORY_TTL, type=click.FloatRange(min=0),
+    help='Minutes before region in inventory is collected again, by default it will be {}'.format(
+        DEFAULT_INVENTORY_TTL),
+)
+def main(profile, flow, filename, workers, volumes, stream, dry_run, contexts, split_clusters, interval, describe_rate,
+         mutate_rate, trace_file, metrics_file, accounts_file, include_regions, exclude_regions, empty_region_skip,
+         output_format, inventory, inventory_ttl, price_cache_ttl, refresh_prices, offline_prices, price_index,
+         department='common'):
     """
 
     A little AWS tool, which will help you organize your AWS EC2 environment with tags and generate
@@ -564,7 +2560,9 @@ def main(profile, flow, filename, department='common'):
 
     FLOW
 
-        Could be: report, update_tags, kube-report
+        Could be: report, update_tags, kube-report, kube-watch, ingest-prices
+
+        For report it could be several profiles, comma separated
 
     Examples:
 
@@ -584,37 +2582,144 @@ def main(profile, flow, filename, department='common'):
 
         main.py stage kube-report    
 
+    5. Get one report for all kubernetes clusters of your kubeconfig
+
+        main.py stage kube-report -c all
+
+    6. Keep kubernetes inventory in memory and save report every hour or on kill -USR1 <pid>
+
+        main.py stage kube-watch --interval 3600
+
+    7. See which tags update_tags would change, plan is saved under reports/ folder
+
+        main.py stage update_tags -f reports/AWS-report-common-xxxxxxxxx-(xxxx-yy-zz).xlsx --dry-run
+
+    8. Generate several department reports in a row, AWS is described only once an hour
+
+        main.py stage report -d <department> --inventory cache/inventory.db
+
+    9. Generate report with AWS prices cached under cache/prices, without calling AWS pricing
+
+        main.py stage report --offline-prices
+
+    10. Generate one report for accounts of profiles stage and prod, every account gets its own sheet
+
+        main.py stage,prod report
+
+    11. Generate report and save where its time went, json trace and Prometheus textfile
+
+        main.py stage report --trace reports/trace.json --metrics /var/lib/node_exporter/aws_report.prom
+
+    12. Generate report only for European regions, regions without instances are skipped for a day
+
+        main.py stage report --regions 'eu-*' --empty-region-skip 24
+
+    13. Price instances of every region by AWS bulk offer file instead of US East prices
+
+        main.py stage ingest-prices -f index.json
+
+        main.py stage report --price-index cache/prices/offer-index.dat
+
+    14. Generate report as parquet file for cost pipeline, nested block devices are kept as list column
+
+        main.py stage report --output-format parquet
+
     Enjoy!
 
     """
 
     start_time = time.time()
 
-    try:
-        boto3.setup_default_session(profile_name=profile, region_name='us-east-1')
-    except Exception as exception:
-        logging.info(exception)
-        logging.info('Check that profile {} exists under ~/.aws/credentials'.format(profile))
+    profiles = [name.strip() for name in profile.split(',') if name.strip()]
+    if accounts_file is not None:
+        accounts = configparser.ConfigParser()
+        if not accounts.read(accounts_file):
+            logging.info('Can not read accounts file {}'.format(accounts_file))
+            exit(1)
+        profiles += [accounts.get(section, 'profile', fallback=section) for section in accounts.sections()]
+    if len(profiles) > 1 and flow != 'report':
+        logging.info('Only report works with several profiles, got - {}'.format(', '.join(profiles)))
         exit(1)
 
+    for name in profiles:
+        try:
+            boto3.session.Session(profile_name=name)
+        except Exception as exception:
+            logging.info(exception)
+            logging.info('Check that profile {} exists under ~/.aws/credentials'.format(name))
+            exit(1)
+
     logging.info('Welcome to tag optimizer')
-    logging.info('We are working for profile - {}'.format(profile))
-
-    if flow == 'report':
-        logging.info('Getting report from your profile, find it under reports/ folder')
-        report = GetReports()
-        report.get_report_excel(department)
-    elif flow == 'update_tags':
-        logging.info('Updating tags from file - {}'.format(filename))
-        tags = UpdateTags(filename)
-        tags.update_tags()
-    elif flow == 'kube-report':
-        logging.info('Generating kub-report')
-        kub_report = GetReportKubernetes()
-        kub_report.get_report_excel()
-    else:
-        logging.info('Not existing flow - {}, valid flows are: report, update_tags, kube-report'.format(flow))
-        exit(1)
+    logging.info('We are working for profile - {}'.format(', '.join(profiles)))
+
+    if output_format == 'parquet':
+        ParquetTableWriter.load_pyarrow()
+
+    trace = RunTrace(flow)
+    clients = AwsClients(workers, trace=trace, rate=RateController(describe_rate, mutate_rate, workers, trace))
+    try:
+        if flow == 'report':
+            logging.info('Getting report from your profile, find it under reports/ folder')
+            price_cache = PriceCache(ttl=price_cache_ttl, refresh=refresh_prices, offline=offline_prices)
+            inventory = InventoryStore(inventory, inventory_ttl) if inventory is not None else None
+            if price_index is not None:
+                if not os.path.exists(price_index):
+                    logging.info('No price index {}, build it with ingest-prices'.format(price_index))
+                    exit(1)
+                price_index = PriceIndex(price_index)
+            catalog = RegionCatalog(empty_skip=empty_region_skip,
+                                    include=[name.strip() for name in (include_regions or '').split(',')],
+                                    exclude=[name.strip() for name in (exclude_regions or '').split(',')])
+            if len(profiles) > 1:
+                report = GetReportsAccounts(profiles, workers=workers, price_cache=price_cache, volumes=volumes,
+                                            inventory=inventory, clients=clients, trace=trace, catalog=catalog,
+                                            price_index=price_index, output_format=output_format)
+            else:
+                report = GetReports(profile=profiles[0], workers=workers, price_cache=price_cache, volumes=volumes,
+                                    inventory=inventory, clients=clients, trace=trace, catalog=catalog,
+                                    price_index=price_index, output_format=output_format)
+            try:
+                report.get_report_excel(department)
+            except PriceCacheError as exception:
+                logging.info(exception)
+                exit(1)
+        elif flow == 'update_tags':
+            logging.info('Updating tags from file - {}'.format(filename))
+            tags = UpdateTags(filename, profile=profile, workers=workers, dry_run=dry_run, stream=stream,
+                              inventory=InventoryStore(inventory, inventory_ttl) if inventory is not None else None,
+                              clients=clients, trace=trace)
+            tags.update_tags()
+        elif flow == 'kube-report':
+            logging.info('Generating kub-report')
+            if contexts is not None:
+                kub_report = GetReportKubernetesClusters(contexts, workers=workers, trace=trace,
+                                                         output_format=output_format)
+                kub_report.get_report_excel(split=split_clusters)
+            else:
+                kub_report = GetReportKubernetes(trace=trace, output_format=output_format)
+                kub_report.get_report_excel()
+        elif flow == 'kube-watch':
+            if contexts is not None and (contexts == 'all' or ',' in contexts):
+                logging.info('kube-watch works with one context, got - {}'.format(contexts))
+                exit(1)
+            logging.info('Watching kubernetes, report is saved every {} seconds and on SIGUSR1'.format(interval))
+            KubeInventory(GetReportKubernetes(contexts, trace=trace, output_format=output_format)).run(interval)
+        elif flow == 'ingest-prices':
+            if filename is None:
+                logging.info('Provide AWS bulk offer files for ingest-prices with -f')
+                exit(1)
+            IngestPrices([name.strip() for name in filename.split(',') if name.strip()],
+                         index_path=price_index or DEFAULT_PRICE_INDEX, trace=trace).ingest()
+        else:
+            logging.info('Not existing flow - {}, valid flows are: report, update_tags, kube-report, kube-watch, '
+                         'ingest-prices'.format(flow))
+            exit(1)
+    finally:
+        trace.log_summary()
+        if trace_file is not None:
+            trace.write(trace_file)
+        if metrics_file is not None:
+            trace.write_prometheus(metrics_file)
 
     logging.info('Done')
     logging.info('Whole process took {} seconds'.format(round(time.time() - start_time), 0))
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+
+import main
+
+WAIT_TIMEOUT = 10  # seconds, other accounts must not wait for a region which is still collected
+
+
+def instance(instance_id, department):
+    return {'InstanceId': instance_id, 'Tags': [{'Key': 'Department', 'Value': department}]}
+
+
+class InventoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='inventory-')
+        self.store = main.InventoryStore(os.path.join(self.folder, 'inventory.db'))
+
+    def tearDown(self):
+        self.store.connection.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def ids(self, account_id, regions, department=None):
+        return [item['InstanceId'] for item in self.store.iter_instances(account_id, regions, department)]
+
+    def test_replace_region(self):
+        self.store.replace_region('1', 'eu-west-1', [instance('i-1', 'a'), instance('i-2', 'b')])
+        self.store.replace_region('1', 'us-east-1', [instance('i-3', 'a')])
+        self.store.replace_region('1', 'eu-west-1', [instance('i-4', 'a'), instance('i-1', 'b')])
+        self.assertEqual(self.ids('1', ['eu-west-1', 'us-east-1']), ['i-4', 'i-1', 'i-3'])
+        self.assertEqual(self.ids('1', ['eu-west-1', 'us-east-1'], 'a'), ['i-4', 'i-3'])
+        self.assertEqual(self.store.region_instance_ids('1', 'eu-west-1'), {'i-1', 'i-4'})
+        self.assertIsNone(self.store.region_instance_ids('2', 'eu-west-1'))
+        self.assertEqual(self.store.stale_regions('1', ['eu-west-1', 'ap-south-1']), ['ap-south-1'])
+
+    # Regions are staged in batches, batch size is made small so a region takes several of them
+    def test_region_of_several_batches(self):
+        batch_size = main.INVENTORY_BATCH_SIZE
+        main.INVENTORY_BATCH_SIZE = 3
+        try:
+            self.store.replace_region('1', 'eu-west-1', [instance('i-{}'.format(n), 'a') for n in range(10)])
+        finally:
+            main.INVENTORY_BATCH_SIZE = batch_size
+        self.assertEqual(self.ids('1', ['eu-west-1'], 'a'), ['i-{}'.format(n) for n in range(10)])
+
+    # While one account waits for its next instances, other accounts use the store and see old data of region
+    def test_store_is_not_locked_while_region_is_collected(self):
+        self.store.replace_region('1', 'eu-west-1', [instance('i-old', 'a')])
+        waiting = threading.Event()
+        release = threading.Event()
+
+        def instances():
+            yield instance('i-new', 'a')
+            waiting.set()
+            release.wait(WAIT_TIMEOUT)
+
+        thread = threading.Thread(target=self.store.replace_region, args=('1', 'eu-west-1', instances()))
+        thread.start()
+        try:
+            self.assertTrue(waiting.wait(WAIT_TIMEOUT))
+            result = {}
+            reader = threading.Thread(target=lambda: result.update(
+                stale=self.store.stale_regions('2', ['eu-west-1']), ids=self.ids('1', ['eu-west-1'])))
+            reader.start()
+            reader.join(WAIT_TIMEOUT / 2)
+            self.assertFalse(reader.is_alive(), 'store is locked while region is collected')
+            self.assertEqual(result, {'stale': ['eu-west-1'], 'ids': ['i-old']})
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(self.ids('1', ['eu-west-1']), ['i-new'])
+
+    # Staged instances of a run which failed are not taken by the next one
+    def test_failed_run_leaves_region_as_it_was(self):
+        self.store.replace_region('1', 'eu-west-1', [instance('i-old', 'a')])
+
+        def instances():
+            yield instance('i-new', 'a')
+            raise IOError('connection lost')
+
+        with self.assertRaises(IOError):
+            self.store.replace_region('1', 'eu-west-1', instances())
+        self.assertEqual(self.ids('1', ['eu-west-1']), ['i-old'])
+        self.store.replace_region('1', 'eu-west-1', [instance('i-other', 'b')])
+        self.assertEqual(self.ids('1', ['eu-west-1']), ['i-other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
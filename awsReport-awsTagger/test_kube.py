@@ -0,0 +1,79 @@
+import unittest
+
+import main
+
+
+class ParseQuantityTest(unittest.TestCase):
+
+    def test_quantities(self):
+        quantities = {
+            '250m': 0.25,
+            '1.5': 1.5,
+            '512Mi': 512 * 2 ** 20,
+            '1Gi': 2 ** 30,
+            '1e3': 1000,
+            '1E': 1e18,
+            '2k': 2000,
+            '100Ki': 102400,
+            '+.5': 0.5,
+            ' 64Mi ': 64 * 2 ** 20,
+            0: 0,
+        }
+        for quantity, value in quantities.items():
+            self.assertAlmostEqual(main.GetReportKubernetes.parse_quantity(quantity), value, msg=quantity)
+
+    def test_not_valid_quantities(self):
+        for quantity in ('', 'abc', '1.5.5', '10MB', 'm'):
+            with self.assertRaises(ValueError, msg=quantity):
+                main.GetReportKubernetes.parse_quantity(quantity)
+
+
+class KubeResourcesTest(unittest.TestCase):
+
+    # Service a has a container without requests, only two of three pods of service b are found in the cluster
+    def setUp(self):
+        self.resources = main.KubeResources()
+        self.resources.add_service('svc-a', 'a', 'team-a', ['p1', 'p2'], [
+            [{'cpu': '250m', 'memory': '512Mi'}, {'cpu': '1.5', 'memory': '1Gi'}],
+            [{'cpu': '250m', 'memory': '512Mi'}, None]])
+        self.resources.add_service('svc-b', 'a', 'team-b', ['p3', 'p4', 'p5'], [
+            [{'cpu': '100m', 'memory': '128Mi'}],
+            [{'cpu': '200m', 'memory': '384Mi'}]])
+        self.resources.add_service('svc-c', 'b', 'team-a', ['p6'], [
+            [{'cpu': '2', 'memory': '2Gi'}]])
+
+    def test_service_rows(self):
+        self.assertEqual(list(self.resources.service_rows()), [
+            ['svc-a', 'a', 'team-a', 2, 1000, 1024, 2000, 2048, 126.0, 32.0],
+            ['svc-b', 'a', 'team-b', 3, 150, 256, 300, 512, 18.9, 8.0],
+            ['svc-c', 'b', 'team-a', 1, 2000, 2048, 2000, 2048, 126.0, 32.0],
+        ])
+
+    def test_namespace_rows(self):
+        self.assertEqual(list(self.resources.rollup_rows('namespace')), [
+            ['a', 2, 5, 2300, 2560, 144.9, 40.0, 184.9],
+            ['b', 1, 1, 2000, 2048, 126.0, 32.0, 158.0],
+        ])
+
+    def test_owner_rows(self):
+        self.assertEqual(list(self.resources.rollup_rows('owner')), [
+            ['team-a', 2, 3, 4000, 4096, 252.0, 64.0, 316.0],
+            ['team-b', 1, 3, 300, 512, 18.9, 8.0, 26.9],
+        ])
+
+    # Rows of aggregated report data are the same as rows of resources added one by one
+    def test_aggregate(self):
+        all_data = [[{'service-name': name}, {'pods': pods}, {'namespace': namespace},
+                     {'pods_resources': pods_resources}, {'owner': owner}]
+                    for name, namespace, owner, pods, pods_resources in (
+                        ('svc-a', 'a', 'team-a', ['p1'], [[{'cpu': '500m', 'memory': '1Gi'}]]),
+                        ('svc-b', 'b', 'Not set', ['p2', 'p3'], [[{'cpu': '1', 'memory': '256Mi'}],
+                                                                 [{'cpu': '1', 'memory': '256Mi'}]]))]
+        self.assertEqual(list(main.GetReportKubernetes.aggregate(all_data).service_rows()), [
+            ['svc-a', 'a', 'team-a', 1, 500, 1024, 500, 1024, 31.5, 16.0],
+            ['svc-b', 'b', 'Not set', 2, 1000, 256, 2000, 512, 126.0, 8.0],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
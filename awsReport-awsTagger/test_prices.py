@@ -0,0 +1,225 @@
+import io
+import os
+import csv
+import json
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import main
+
+# Strings which look like json structure, they must not be counted as brackets when terms are skipped
+TRICKY = 'say "{hi}" [x] \\ end\\'
+CHUNK_SIZES = [1, 2, 3, 7, 64, main.OFFER_CHUNK_SIZE]
+
+
+def instance(sku, instance_type, operating_system='Linux', tenancy='Shared', family='Compute Instance', **attributes):
+    defaults = {'instanceType': instance_type, 'operatingSystem': operating_system, 'tenancy': tenancy,
+                'preInstalledSw': 'NA', 'capacitystatus': 'Used', 'licenseModel': 'No License required',
+                'locationType': 'AWS Region', 'note': TRICKY}
+    return sku, {'sku': sku, 'productFamily': family, 'attributes': dict(defaults, **attributes)}
+
+
+def volume(sku, volume_type, **attributes):
+    defaults = {'volumeApiName': volume_type, 'locationType': 'AWS Region'}
+    return sku, {'sku': sku, 'productFamily': 'Storage', 'attributes': dict(defaults, **attributes)}
+
+
+def on_demand(sku, price, unit='Hrs'):
+    return sku, {sku + '.T': {'priceDimensions': {sku + '.T.R': {'unit': unit, 'description': TRICKY,
+                                                                  'pricePerUnit': {'USD': str(price)}}}}}
+
+
+# Offer with products of two regions, one found by regionCode and one by location only.
+# Reserved terms come first and have prices which must not be taken
+PRODUCTS = dict([
+    instance('LINUX', 'm5.large', regionCode='us-east-1', location='US East (N. Virginia)'),
+    instance('WINDOWS', 'm5.large', 'Windows', regionCode='us-east-1', location='US East (N. Virginia)'),
+    instance('METAL', 'm5.metal', family='Compute Instance (bare metal)', regionCode='us-east-1',
+             location='US East (N. Virginia)'),
+    instance('DEDICATED', 'c5.xlarge', tenancy='Dedicated', location='EU (Ireland)'),
+    instance('SQL', 'c5.xlarge', location='EU (Ireland)', preInstalledSw='SQL Std'),
+    instance('LOCAL_ZONE', 'c5.xlarge', regionCode='us-east-1-bos-1', location='US East (Boston)',
+             locationType='AWS Local Zone'),
+    volume('GP3', 'gp3', regionCode='us-east-1', location='US East (N. Virginia)'),
+    volume('IO1', 'io1', location='EU (Ireland)'),
+])
+ON_DEMAND = dict([on_demand('LINUX', 0.096), on_demand('WINDOWS', 0.188), on_demand('METAL', 4.608),
+                  on_demand('DEDICATED', 0.21), on_demand('SQL', 1.5), on_demand('LOCAL_ZONE', 0.2),
+                  on_demand('GP3', 0.08, 'GB-Mo'), on_demand('IO1', 0.138, 'GB-Mo')])
+RESERVED = dict((sku, {sku + '.R': {'priceDimensions': {sku + '.R.U': {'pricePerUnit': {'USD': '99'},
+                                                                       'description': TRICKY}},
+                                    'termAttributes': [[1, 2.5e-3], None, True, {'}': ']'}]}})
+                for sku in PRODUCTS)
+OFFER = {'formatVersion': 'v1.0', 'disclaimer': TRICKY, 'offerCode': 'AmazonEC2', 'version': 20261018,
+         'products': PRODUCTS, 'terms': {'Reserved': RESERVED, 'OnDemand': ON_DEMAND}, 'attributesList': {}}
+PRICES = {
+    ('us-east-1', 'm5.large', 'Linux', 'Shared'): 0.096,
+    ('us-east-1', 'm5.large', 'Windows', 'Shared'): 0.188,
+    ('us-east-1', 'm5.metal', 'Linux', 'Shared'): 4.608,
+    ('us-east-1', 'gp3', '', ''): 0.08,
+    ('eu-west-1', 'c5.xlarge', 'Linux', 'Dedicated'): 0.21,
+    ('eu-west-1', 'io1', '', ''): 0.138,
+}
+
+
+class OfferJsonReaderTest(unittest.TestCase):
+
+    # Read products and on demand terms like ingest-prices does, everything else is skipped
+    @staticmethod
+    def read(text, chunk_size):
+        reader = main.OfferJsonReader(io.StringIO(text), chunk_size)
+        offer = {}
+        for key in reader.members():
+            if key == 'products':
+                offer[key] = dict((sku, reader.value()) for sku in reader.members())
+            elif key == 'terms':
+                offer[key] = {}
+                for term_type in reader.members():
+                    if term_type == 'OnDemand':
+                        offer[key][term_type] = dict((sku, reader.value()) for sku in reader.members())
+                    else:
+                        reader.skip()
+            else:
+                reader.skip()
+        return offer
+
+    def test_every_chunk_size(self):
+        expected = {'products': PRODUCTS, 'terms': {'OnDemand': ON_DEMAND}}
+        for indent in (None, 4):
+            text = json.dumps(OFFER, indent=indent)
+            for chunk_size in CHUNK_SIZES:
+                self.assertEqual(self.read(text, chunk_size), expected, (indent, chunk_size))
+
+    def test_number_split_by_chunk(self):
+        reader = main.OfferJsonReader(io.StringIO('{"a": 12345.678, "b": [1, 2]}'), 3)
+        self.assertEqual([(key, reader.value()) for key in reader.members()], [('a', 12345.678), ('b', [1, 2])])
+
+    def test_empty_object(self):
+        self.assertEqual(list(main.OfferJsonReader(io.StringIO(' { } '), 1).members()), [])
+
+    def test_truncated_offer(self):
+        with self.assertRaises(ValueError):
+            self.read(json.dumps(OFFER)[:-100], 7)
+
+
+class PricesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='prices-')
+        self.index_path = os.path.join(self.folder, 'index', 'offer-index.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write_json(self, name):
+        path = os.path.join(self.folder, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as offer_file:
+            json.dump(OFFER, offer_file, indent=4)
+        return path
+
+    # Csv offer as AWS publishes it, a few lines about the offer, header and every price as a row
+    def write_csv(self, name):
+        columns = dict((attribute, name) for name, attribute in main.OFFER_CSV_COLUMNS.items())
+        header = ['SKU', 'OfferTermCode', 'TermType', 'PriceDescription', 'Unit', 'PricePerUnit', 'Currency'] + \
+            sorted(columns.values())
+        path = os.path.join(self.folder, name)
+        with open(path, 'w', newline='') as offer_file:
+            writer = csv.writer(offer_file, quoting=csv.QUOTE_ALL)
+            writer.writerow(['FormatVersion', 'v1.0'])
+            writer.writerow(['Disclaimer', TRICKY])
+            writer.writerow(['OfferCode', 'AmazonEC2'])
+            writer.writerow(header)
+            for sku, product in sorted(PRODUCTS.items()):
+                attributes = dict(product['attributes'], productFamily=product['productFamily'])
+                for term_type, terms in (('Reserved', RESERVED), ('OnDemand', ON_DEMAND)):
+                    for term in terms[sku].values():
+                        for dimension in term['priceDimensions'].values():
+                            values = {'SKU': sku, 'TermType': term_type, 'PriceDescription': TRICKY,
+                                      'Unit': dimension.get('unit', ''), 'Currency': 'USD',
+                                      'PricePerUnit': dimension['pricePerUnit']['USD']}
+                            values.update((columns[attribute], value) for attribute, value in attributes.items()
+                                          if attribute in columns)
+                            writer.writerow([values.get(column, '') for column in header])
+        return path
+
+    def test_offer_files(self):
+        ingest = main.IngestPrices([], self.index_path)
+        for path in (self.write_json('offer.json'), self.write_json('offer.json.gz'), self.write_csv('offer.csv')):
+            self.assertEqual(dict(ingest._read_offer(path)), PRICES, path)
+
+    def test_ingest_and_region_lookups(self):
+        main.IngestPrices([self.write_json('offer.json')], self.index_path).ingest()
+        index = main.PriceIndex(self.index_path)
+        self.assertEqual(index.region_prices('us-east-1'), (
+            {('m5.large', 'Linux', 'Shared'): 0.096, ('m5.large', 'Windows', 'Shared'): 0.188,
+             ('m5.metal', 'Linux', 'Shared'): 4.608},
+            {'gp3': 0.08}))
+        self.assertEqual(index.region_prices('eu-west-1'), ({('c5.xlarge', 'Linux', 'Dedicated'): 0.21},
+                                                            {'io1': 0.138}))
+        self.assertIsNone(index.region_prices('us-east-1-bos-1'))
+        self.assertIsNone(index.region_prices('eu-west-2'))
+
+    # Neighbours of region in sorted index are not taken, whichever side they are
+    def test_region_between_others(self):
+        main.PriceIndex.write(self.index_path, {
+            ('eu-west-1', 't3.micro', 'Linux', 'Shared'): 0.0114,
+            ('eu-west-2', 't3.micro', 'Linux', 'Shared'): 0.0118,
+            ('eu-west-2', 'gp2', '', ''): 0.116,
+            ('eu-west-3', 't3.micro', 'Linux', 'Shared'): 0.0118,
+        })
+        index = main.PriceIndex(self.index_path)
+        self.assertEqual(index.region_prices('eu-west-2'), ({('t3.micro', 'Linux', 'Shared'): 0.0118},
+                                                            {'gp2': 0.116}))
+        self.assertIsNone(index.region_prices('eu-west'))
+        self.assertIsNone(index.region_prices('us-east-1'))
+
+    def test_empty_index(self):
+        main.PriceIndex.write(self.index_path, {})
+        self.assertIsNone(main.PriceIndex(self.index_path).region_prices('us-east-1'))
+
+
+class PriceInstancesTest(unittest.TestCase):
+
+    @staticmethod
+    def instance(instance_id, instance_type, platform='Linux/UNIX', tenancy='default'):
+        return {'InstanceId': instance_id, 'InstanceType': instance_type, 'PlatformDetails': platform,
+                'Placement': {'Tenancy': tenancy}, 'State': {'Name': 'running'}, 'LaunchTime': '',
+                'BlockDeviceMappings': []}
+
+    def hourly_prices(self, ec2_price_index, instances):
+        return dict((priced['InstanceId'], round(priced['Price']['instance_price_per_month'] / 24 / 30.5, 4))
+                    for priced in main.GetReports._price_instances('eu-west-1', instances, ec2_price_index, {}))
+
+    # Platform and tenancy which are not in the lookup fall back to Linux, then to shared
+    def test_price_index_lookups(self):
+        ec2_price_index = {('m5.large', 'Linux', 'Shared'): 0.1, ('m5.large', 'Windows', 'Shared'): 0.2,
+                           ('m5.large', 'Linux', 'Dedicated'): 0.3}
+        self.assertEqual(self.hourly_prices(ec2_price_index, [
+            self.instance('linux', 'm5.large'),
+            self.instance('windows', 'm5.large', 'Windows'),
+            self.instance('sql', 'm5.large', 'Windows with SQL Server Standard'),
+            self.instance('dedicated', 'm5.large', tenancy='dedicated'),
+            self.instance('windows-dedicated', 'm5.large', 'Windows', 'dedicated'),
+            self.instance('host', 'm5.large', tenancy='host'),
+            self.instance('unknown', 'c5.large'),
+        ]), {'linux': 0.1, 'windows': 0.2, 'sql': 0.1, 'dedicated': 0.3, 'windows-dedicated': 0.3, 'host': 0.1,
+             'unknown': 0})
+
+    # Pricing API has only prices of shared Linux, every platform and tenancy is priced by them
+    def test_pricing_api_lookups(self):
+        ec2_price_index = main.GetReports._index_prices(
+            [{'instance_type': 'm5.large', 'instance_price': '0.1'}, {'instance_type': 'c5.large',
+                                                                       'instance_price': '0.2'}],
+            lambda item: (item['instance_type'], 'Linux', 'Shared'), 'instance_price')
+        self.assertEqual(self.hourly_prices(ec2_price_index, [
+            self.instance('linux', 'm5.large'),
+            self.instance('windows', 'c5.large', 'Windows'),
+            self.instance('dedicated', 'm5.large', tenancy='dedicated'),
+        ]), {'linux': 0.1, 'windows': 0.2, 'dedicated': 0.1})
+
+
+if __name__ == '__main__':
+    unittest.main()
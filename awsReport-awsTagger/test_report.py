@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+
+import main
+import benchmark
+
+RUN_TIMEOUT = 60  # seconds, an error lost in a worker makes the report wait forever
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='report-')
+        self.current = os.getcwd()
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.current)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    # Run func in a thread, so a hang fails the test instead of blocking it. Returns what func raised
+    def run_func(self, func):
+        result = {}
+
+        def run():
+            try:
+                func()
+            except BaseException as exception:
+                result['exception'] = exception
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(RUN_TIMEOUT)
+        self.assertFalse(thread.is_alive(), 'run did not finish')
+        return result.get('exception')
+
+    def test_exit_of_worker_stops_stream(self):
+        def items(key):
+            if key == 2:
+                exit(1)
+            return range(3)
+
+        exception = self.run_func(lambda: list(main.stream_parallel([1, 2, 3], items, 2)))
+        self.assertIsInstance(exception, SystemExit)
+
+    def test_offline_prices_without_cache(self):
+        account = benchmark.SyntheticAccount(100, benchmark.DEFAULT_REGIONS, 1, benchmark.DEFAULT_SKUS)
+        report = main.GetReports(workers=4, price_cache=main.PriceCache(offline=True),
+                                 clients=benchmark.SyntheticClients(account, 4))
+        exception = self.run_func(lambda: report.get_report_excel('common'))
+        self.assertIsInstance(exception, main.PriceCacheError)
+
+    def test_offline_prices_without_cache_several_accounts(self):
+        accounts = dict((profile, benchmark.SyntheticAccount(100, benchmark.DEFAULT_REGIONS, 1, benchmark.DEFAULT_SKUS))
+                        for profile in ('first', 'second'))
+
+        # Clients of every profile answer from its own synthetic account
+        class Clients(benchmark.SyntheticClients):
+            def _new_session(self, profile):
+                return accounts[profile].session()
+
+        report = main.GetReportsAccounts(['first', 'second'], workers=4, price_cache=main.PriceCache(offline=True),
+                                         clients=Clients(None, 4))
+        exception = self.run_func(lambda: report.get_report_excel('common'))
+        self.assertIsInstance(exception, main.PriceCacheError)
+
+
+if __name__ == '__main__':
+    unittest.main()
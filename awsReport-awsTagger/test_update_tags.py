@@ -0,0 +1,224 @@
+import os
+import csv
+import shutil
+import zipfile
+import tempfile
+import unittest
+import threading
+import collections
+import boto3
+import xlsxwriter
+from urllib.parse import parse_qs
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import EndpointConnectionError
+
+import main
+
+DESCRIBE_TAGS = b'<DescribeTagsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">' \
+                b'<requestId>1</requestId><tagSet></tagSet></DescribeTagsResponse>'
+CREATE_TAGS = b'<CreateTagsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">' \
+              b'<requestId>1</requestId><return>true</return></CreateTagsResponse>'
+DESCRIBE_INSTANCES = '<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">' \
+                     '<requestId>1</requestId><reservationSet><item><reservationId>r-1</reservationId>' \
+                     '<instancesSet>{}</instancesSet></item></reservationSet></DescribeInstancesResponse>'
+INSTANCE = '<item><instanceId>{}</instanceId></item>'
+THROTTLE = b'<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message>' \
+           b'</Error></Errors><RequestID>1</RequestID></Response>'
+NOT_FOUND = b'<Response><Errors><Error><Code>InvalidInstanceID.NotFound</Code><Message>Not found</Message>' \
+            b'</Error></Errors><RequestID>1</RequestID></Response>'
+PHONETIC = '<rPh sb="0" eb="1"><t>PHONETIC</t></rPh>'
+RUN_TIMEOUT = 60  # seconds, a leaked slot of rate controller makes update_tags wait forever
+
+
+# Body of fake HTTP response
+class RawBody(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+# Fake EC2 answering requests before they are sent: first create_tags calls are throttled,
+# create_tags of broken instances fails with connection error, missing instances are not described
+class FakeEc2(object):
+
+    def __init__(self, throttles=0, broken=(), missing=()):
+        self.throttles = throttles
+        self.broken = set(broken)
+        self.missing = set(missing)
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, request, **kwargs):
+        body = request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body
+        params = parse_qs(body)
+        action = params['Action'][0]
+        with self._lock:
+            self.calls[action] += 1
+            throttled = action == 'CreateTags' and self.throttles > 0
+            if throttled:
+                self.throttles -= 1
+        if action == 'DescribeTags':
+            return AWSResponse(request.url, 200, {}, RawBody(DESCRIBE_TAGS))
+        if action == 'DescribeInstances':
+            ids = sorted(values[0] for key, values in params.items()
+                         if key.startswith('Filter.1.Value.') and values[0] not in self.missing)
+            body = DESCRIBE_INSTANCES.format(''.join(INSTANCE.format(instance_id) for instance_id in ids))
+            return AWSResponse(request.url, 200, {}, RawBody(body.encode('utf-8')))
+        ids = set(values[0] for key, values in params.items() if key.startswith('ResourceId.'))
+        if ids & self.missing:
+            return AWSResponse(request.url, 400, {}, RawBody(NOT_FOUND))
+        if ids & self.broken:
+            raise EndpointConnectionError(endpoint_url=request.url)
+        if throttled:
+            return AWSResponse(request.url, 503, {}, RawBody(THROTTLE))
+        return AWSResponse(request.url, 200, {}, RawBody(CREATE_TAGS))
+
+
+# Clients of fake EC2, nothing leaves the machine
+class FakeClients(main.AwsClients):
+
+    def __init__(self, ec2, trace, rate):
+        super(FakeClients, self).__init__(4, max_attempts=3, trace=trace, rate=rate)
+        self.ec2 = ec2
+
+    def _new_session(self, profile):
+        session = boto3.session.Session(aws_access_key_id='test', aws_secret_access_key='test',
+                                        region_name='us-east-1')
+        session.events.register('before-send', self.ec2)
+        return session
+
+
+class UpdateTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='update-tags-')
+        self.current = os.getcwd()
+        os.chdir(self.folder)
+        # Six instances in three tag sets, every tag set is its own create_tags batch
+        with open('tags.csv', 'w', newline='') as tags_file:
+            writer = csv.writer(tags_file)
+            writer.writerow(main.REPORT_HEADERS)
+            for number in range(6):
+                values = {'Region': 'us-east-1', 'ID': 'i-{}'.format(number), 'Team': 'team-{}'.format(number % 3)}
+                writer.writerow([values.get(header, '') for header in main.REPORT_HEADERS])
+
+    def tearDown(self):
+        os.chdir(self.current)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    # Run update_tags in a thread, so a hang fails the test instead of blocking it
+    def update_tags(self, ec2, concurrency):
+        trace = main.RunTrace('update_tags')
+        rate = main.RateController(describe_rate=100, mutate_rate=100, concurrency=concurrency, trace=trace)
+        tags = main.UpdateTags('tags.csv', workers=4, clients=FakeClients(ec2, trace, rate), trace=trace)
+        result = {}
+
+        def run():
+            try:
+                tags.update_tags()
+                result['code'] = 0
+            except SystemExit as exception:
+                result['code'] = exception.code
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(RUN_TIMEOUT)
+        self.assertFalse(thread.is_alive(), 'update_tags did not finish')
+        for bucket in rate._buckets.values():
+            self.assertEqual(bucket.in_flight, 0)
+        return result['code'], trace
+
+    def failed_ids(self):
+        with open('reports/AWS-tags-failed-({}).csv'.format(main.date)) as failed_file:
+            return sorted(row[main.REPORT_HEADERS.index('ID')] for row in list(csv.reader(failed_file))[1:])
+
+    def test_throttles_are_retried(self):
+        ec2 = FakeEc2(throttles=2)
+        code, trace = self.update_tags(ec2, concurrency=2)
+        self.assertEqual(code, 0)
+        self.assertEqual(trace.counters['throttles'], 2)
+        self.assertEqual(trace.counters['instances_tagged'], 6)
+        self.assertEqual(ec2.calls['CreateTags'], 5)
+
+    def test_connection_errors_fail_only_their_batch(self):
+        code, trace = self.update_tags(FakeEc2(throttles=2, broken=['i-2']), concurrency=2)
+        self.assertEqual(code, 1)
+        self.assertEqual(self.failed_ids(), ['i-2', 'i-5'])
+        self.assertEqual(trace.counters['instances_tagged'], 4)
+        self.assertEqual(trace.counters['errors'], 1)
+
+    def test_connection_errors_do_not_leak_slots(self):
+        code, _ = self.update_tags(FakeEc2(broken=['i-0', 'i-1', 'i-2']), concurrency=1)
+        self.assertEqual(code, 1)
+        self.assertEqual(self.failed_ids(), ['i-{}'.format(number) for number in range(6)])
+
+    def test_missing_instances_are_skipped(self):
+        ec2 = FakeEc2(missing=['i-1'])
+        code, trace = self.update_tags(ec2, concurrency=2)
+        self.assertEqual(code, 0)
+        self.assertEqual(trace.counters['instances_not_found'], 1)
+        self.assertEqual(trace.counters['instances_tagged'], 5)
+        self.assertEqual(ec2.calls['CreateTags'], 3)
+
+
+class ReadRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='read-rows-')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    # Sheet with numbers, empty cells, skipped rows and rich text. Constant memory mode writes inline strings,
+    # otherwise strings are shared. Phonetic runs are added to every string, xlsxwriter does not write them
+    def write_xlsx(self, name, constant_memory):
+        path = os.path.join(self.folder, name)
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': constant_memory})
+        bold = workbook.add_format({'bold': True})
+        sheet = workbook.add_worksheet('Tags')
+        sheet.write_row(0, 0, main.REPORT_HEADERS)
+        column = dict((header, number) for number, header in enumerate(main.REPORT_HEADERS))
+        sheet.write_row(1, 0, ['us-east-1', 'web', 'i-1'])
+        sheet.write_number(1, column['Department'], 42)
+        sheet.write_number(1, column['Team'], 2.5)
+        sheet.write_rich_string(1, column['Team Owner'], 'John ', bold, 'Smith', ' [ops]')
+        sheet.write_string(1, column['Environment'], 'prod "eu" & <test>')
+        sheet.write_row(2, 0, ['us-east-1', 'no id'])
+        sheet.write_row(4, 0, ['eu-west-1', '', 'i-2', 't3.micro'])
+        sheet.write_rich_string(4, column['Project'], bold, 'Big', ' project')
+        sheet.write_string(4, column['Finance'], 'x' * 300)
+        sheet.write_row(5, 0, ['eu-west-1', '', 'i-3'])
+        workbook.close()
+
+        with zipfile.ZipFile(path) as book:
+            parts = [(item, book.read(item.filename)) for item in book.infolist()]
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as book:
+            for item, data in parts:
+                if item.filename.endswith('.xml'):
+                    data = data.replace(b'</si>', PHONETIC.encode('utf-8') + b'</si>')
+                    data = data.replace(b'</is>', PHONETIC.encode('utf-8') + b'</is>')
+                book.writestr(item, data)
+        return path
+
+    def read_rows(self, path, stream):
+        return list(main.UpdateTags(path, stream=stream).read_rows())
+
+    def test_stream_reads_like_xlrd(self):
+        expected = [
+            main.TagRow('us-east-1', 'i-1', '42', '2.5', 'John Smith [ops]', '', '', 'prod "eu" & <test>'),
+            main.TagRow('eu-west-1', 'i-2', '', '', '', 'Big project', 'x' * 300, ''),
+            main.TagRow('eu-west-1', 'i-3', '', '', '', '', '', ''),
+        ]
+        for constant_memory in (False, True):
+            path = self.write_xlsx('tags-{}.xlsx'.format(constant_memory), constant_memory)
+            with zipfile.ZipFile(path) as book:
+                self.assertIn(b'PHONETIC', b''.join(book.read(name) for name in book.namelist()))
+            self.assertEqual(self.read_rows(path, stream=False), expected, constant_memory)
+            self.assertEqual(self.read_rows(path, stream=True), expected, constant_memory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,13 @@
+import os
+import json
+import time
 import boto3
+import threading
+import contextlib
+import collections
+from botocore.config import Config
 from ConfigParser import ConfigParser
+from multiprocessing.pool import ThreadPool
 
 # Parser for conf.ini where stored all configuration
 config = ConfigParser()
@@ -9,91 +17,300 @@ account = config.get("main", "account")
 source_region = config.get("main", "source_region")
 dest_region = config.get("main", "dest_region")
 dest_vpc_id = config.get("main", "dest_vpc_id")
-source_sg_id = config.get("main", "source_sg_id")
-
-sourceSG_details = {}
-new_sg_id = ''
-
-
-# Get vpcid, groupname, description from source SG
-def get_sourceSG_details():
-    boto3.setup_default_session(profile_name=account)
-    ec2 = boto3.client('ec2', source_region)
-    all_SG = ec2.describe_security_groups()['SecurityGroups']
-    for group in all_SG:
-        if group['GroupId'] == source_sg_id:
-            sourceSG_details['vpcid'] = group['VpcId']
-            sourceSG_details['groupname'] = group['GroupName']
-            sourceSG_details['description'] = group['Description']
-        else:
-            pass
-    return sourceSG_details
-
-
-# Get all rules from source SG and add them to dict
-def get_sourceSG_rules():
-    boto3.setup_default_session(profile_name=account)
-    ec2 = boto3.client('ec2', source_region)
-    all_SG = ec2.describe_security_groups()['SecurityGroups']
-    for group in all_SG:
-        if group['GroupId'] == source_sg_id:
-            rules = group['IpPermissions']
-    return rules
-
-
-# Create new security group in dest region
-def create_new_sg():
-    boto3.setup_default_session(profile_name=account)
-    ec2 = boto3.client('ec2', dest_region)
+# Groups to move, any of: comma separated ids, whole VPC, filters like tag:Team=web;group-name=app-*
+source_sg_id = config.get("main", "source_sg_id") if config.has_option("main", "source_sg_id") else ''
+source_vpc_id = config.get("main", "source_vpc_id") if config.has_option("main", "source_vpc_id") else ''
+source_filter = config.get("main", "source_filter") if config.has_option("main", "source_filter") else ''
+workers = config.getint("main", "workers") if config.has_option("main", "workers") else 10
+# Files for trace of the run, json and Prometheus textfile
+trace_file = config.get("main", "trace") if config.has_option("main", "trace") else ''
+metrics_file = config.get("main", "metrics") if config.has_option("main", "metrics") else ''
+
+# Clients of the run, one per region, shared by all workers with connection pool for all of them
+clients = {}
+clients_lock = threading.Lock()
+client_config = Config(max_pool_connections=workers, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+# Trace of the run: phases timings, API calls, retries, throttles and counts of moved groups and rules
+trace = {'started': time.time(), 'phases': collections.OrderedDict(), 'api_calls': collections.Counter(),
+         'counters': collections.Counter()}
+trace_lock = threading.Lock()
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled',
+                  'RequestThrottledException', 'TooManyRequestsException', 'EC2ThrottledException')
+
+# Egress rule which AWS adds to every new SG
+DEFAULT_EGRESS = {'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}
+# Kinds of rule sources which are copied as is, referenced groups and prefix lists are rewritten to dest ones
+RULE_RANGES = ('IpRanges', 'Ipv6Ranges')
+RULE_REFERENCES = ('PrefixListIds', 'UserIdGroupPairs')
+
+
+# Client of region, created on first use, boto3 clients are thread safe unlike sessions
+def get_client(region):
+    with clients_lock:
+        if region not in clients:
+            session = boto3.session.Session(profile_name=account)
+            session.events.register('after-call', trace_call)
+            session.events.register('after-call-error', trace_call)
+            session.events.register('needs-retry', trace_retry)
+            clients[region] = session.client('ec2', region, config=client_config)
+        return clients[region]
+
+
+# Count of processed things in trace
+def count(name, value=1):
+    with trace_lock:
+        trace['counters'][name] += value
+
+
+# Measure block of code as phase of trace
+@contextlib.contextmanager
+def phase(name):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        with trace_lock:
+            trace['phases'][name] = round(time.time() - start_time, 3)
+
+
+# Count API call with its retries, for calls which succeeded and which failed.
+# Calls which failed without response get only exception and context, operation is taken from event name then
+def trace_call(model=None, parsed=None, exception=None, event_name='', **kwargs):
+    response = parsed if parsed is not None else getattr(exception, 'response', None) or {}
+    with trace_lock:
+        trace['api_calls'][model.name if model is not None else event_name.split('.')[-1]] += 1
+        trace['counters']['retries'] += response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if exception is not None:
+            trace['counters']['errors'] += 1
+
+
+def trace_retry(response=None, **kwargs):
+    if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+        count('throttles')
+
+
+# Save trace as json and as Prometheus textfile if they are set in config.ini
+def write_trace():
+    with trace_lock:
+        result = {'seconds': round(time.time() - trace['started'], 3), 'phases': trace['phases'],
+                  'api_calls': dict(trace['api_calls']), 'counters': dict(trace['counters'])}
+    print('Took {0} seconds, {1} API calls, {2} retries, {3} throttles'.format(
+        result['seconds'], sum(result['api_calls'].values()), result['counters'].get('retries', 0),
+        result['counters'].get('throttles', 0)))
+    if trace_file:
+        with open(trace_file, 'w') as output:
+            json.dump(result, output, indent=2)
+    if metrics_file:
+        lines = ['move_sg_run_seconds {0}'.format(result['seconds'])]
+        lines += ['move_sg_phase_seconds{{phase="{0}"}} {1}'.format(name, seconds)
+                  for name, seconds in result['phases'].items()]
+        lines += ['move_sg_api_calls{{operation="{0}"}} {1}'.format(operation, calls)
+                  for operation, calls in sorted(result['api_calls'].items())]
+        lines += ['move_sg_count{{name="{0}"}} {1}'.format(name, value)
+                  for name, value in sorted(result['counters'].items())]
+        with open(metrics_file + '.tmp', 'w') as output:
+            output.write('\n'.join(lines) + '\n')
+        os.rename(metrics_file + '.tmp', metrics_file)
+
+
+# Filters for describe_security_groups from config
+def get_source_filters():
+    filters = []
+    if source_vpc_id:
+        filters.append({'Name': 'vpc-id', 'Values': [source_vpc_id]})
+    for item in source_filter.split(';'):
+        if '=' in item:
+            name, values = item.split('=', 1)
+            filters.append({'Name': name.strip(), 'Values': [value.strip() for value in values.split(',')]})
+    return filters
+
+
+# Get source SGs with calls filtered on AWS side
+def get_source_groups():
+    ids = [group_id.strip() for group_id in source_sg_id.split(',') if group_id.strip()]
+    filters = get_source_filters()
+    if not ids and not filters:
+        raise Exception('Provide source_sg_id, source_vpc_id or source_filter in config.ini')
+    params = {'Filters': filters}
+    if ids:
+        params['GroupIds'] = ids
+    groups = []
+    for page in get_client(source_region).get_paginator('describe_security_groups').paginate(**params):
+        groups += page['SecurityGroups']
+    return groups
+
+
+# Get id of dest SG by its name, it is used for default SG and for SG created by previous run
+def get_dest_group_id(group_name):
+    groups = get_client(dest_region).describe_security_groups(
+        Filters=[{'Name': 'vpc-id', 'Values': [dest_vpc_id]},
+                 {'Name': 'group-name', 'Values': [group_name]}])['SecurityGroups']
+    return groups[0]['GroupId'] if groups else None
+
+
+# Create new security group in dest region, default SG of source is mapped to default SG of dest VPC
+def create_new_sg(group):
+    if group['GroupName'] == 'default':
+        return group['GroupId'], get_dest_group_id('default'), False
     try:
-        response = ec2.create_security_group(GroupName=sourceSG_details['groupname'],
-                                             Description="{0} (copied from {1} automatically)".format(
-                                                 sourceSG_details['description'], source_region),
-                                             VpcId=dest_vpc_id)
-        global new_sg_id
-        new_sg_id = response['GroupId']
+        response = get_client(dest_region).create_security_group(
+            GroupName=group['GroupName'],
+            Description="{0} (copied from {1} automatically)".format(group['Description'], source_region),
+            VpcId=dest_vpc_id)
+        return group['GroupId'], response['GroupId'], True
+    except Exception as e:
+        print(e)
+        return group['GroupId'], get_dest_group_id(group['GroupName']), False
+
+
+# Prefix lists of dest region with the same names as prefix lists used by source SGs, prefix list ids are
+# different in every region. AWS managed prefix lists have region in their names
+def get_prefix_list_map(groups):
+    ids = sorted(set(prefix_list['PrefixListId'] for group in groups
+                     for rule in group['IpPermissions'] + group.get('IpPermissionsEgress', [])
+                     for prefix_list in rule.get('PrefixListIds', [])))
+    if not ids:
+        return {}
+    names = {}
+    for page in get_client(source_region).get_paginator('describe_managed_prefix_lists').paginate(
+            PrefixListIds=ids):
+        for prefix_list in page['PrefixLists']:
+            names[prefix_list['PrefixListName'].replace(source_region, dest_region)] = prefix_list['PrefixListId']
+    prefix_map = {}
+    for page in get_client(dest_region).get_paginator('describe_managed_prefix_lists').paginate(
+            Filters=[{'Name': 'prefix-list-name', 'Values': sorted(names)}]):
+        for prefix_list in page['PrefixLists']:
+            prefix_map[names[prefix_list['PrefixListName']]] = prefix_list['PrefixListId']
+    for prefix_list_id in ids:
+        if prefix_list_id not in prefix_map:
+            print('No prefix list like {0} in {1}, its rules are skipped'.format(prefix_list_id, dest_region))
+    return prefix_map
+
+
+# Copy of referenced prefix lists with ids of dest ones, None if no prefix list is found
+def copy_prefix_lists(prefix_lists, prefix_map):
+    new_prefix_lists = []
+    for prefix_list in prefix_lists:
+        if prefix_list['PrefixListId'] not in prefix_map:
+            continue
+        new_prefix_list = dict(prefix_list, PrefixListId=prefix_map[prefix_list['PrefixListId']])
+        new_prefix_lists.append(new_prefix_list)
+    return new_prefix_lists or None
+
+
+# Copy of referenced groups with ids of their copies, None if no group is copied
+def copy_group_pairs(pairs, id_map):
+    new_pairs = []
+    for pair in pairs:
+        if pair.get('GroupId') not in id_map:
+            print('Skipping rule referencing group {0} which is not moved'.format(pair.get('GroupId')))
+            continue
+        new_pair = {'GroupId': id_map[pair['GroupId']]}
+        if 'Description' in pair:
+            new_pair['Description'] = pair['Description']
+        new_pairs.append(new_pair)
+    return new_pairs or None
+
 
+# Copy of rule with protocol, ports and ranges only, None if nothing is left to copy.
+# For egress default rule is skipped, new SG has it already
+def copy_rule(rule, id_map, prefix_map, egress=False):
+    new_rule = {'IpProtocol': rule['IpProtocol']}
+    for port in ('FromPort', 'ToPort'):
+        if port in rule:
+            new_rule[port] = rule[port]
+    for ranges in RULE_RANGES:
+        values = [value for value in rule.get(ranges, [])
+                  if not (egress and is_default_egress({'IpProtocol': rule['IpProtocol'], ranges: [value]}))]
+        if values:
+            new_rule[ranges] = values
+    prefix_lists = copy_prefix_lists(rule.get('PrefixListIds', []), prefix_map)
+    if prefix_lists:
+        new_rule['PrefixListIds'] = prefix_lists
+    pairs = copy_group_pairs(rule.get('UserIdGroupPairs', []), id_map)
+    if pairs:
+        new_rule['UserIdGroupPairs'] = pairs
+    return new_rule if any(ranges in new_rule for ranges in RULE_RANGES + RULE_REFERENCES) else None
+
+
+# Split rule to rules with one range each
+def split_rule(rule):
+    for ranges in RULE_RANGES + RULE_REFERENCES:
+        for value in rule.get(ranges, []):
+            single = dict((key, rule[key]) for key in ('IpProtocol', 'FromPort', 'ToPort') if key in rule)
+            single[ranges] = [value]
+            yield single
+
+
+# Apply all rules in one call, if it fails every range is applied by its own call to get as much as possible
+def apply_rules(apply, group_id, rules):
+    if not rules:
+        return
+    count('rules', len(rules))
+    try:
+        apply(GroupId=group_id, IpPermissions=rules)
     except Exception as e:
         print(e)
+        for rule in rules:
+            for single in split_rule(rule):
+                try:
+                    apply(GroupId=group_id, IpPermissions=[single])
+                except Exception as e:
+                    print(e)
+
 
+# Check that rule is the egress rule which AWS adds to every new SG
+def is_default_egress(rule):
+    return rule['IpProtocol'] == DEFAULT_EGRESS['IpProtocol'] and \
+        DEFAULT_EGRESS['IpRanges'][0]['CidrIp'] in [ip['CidrIp'] for ip in rule.get('IpRanges', [])]
 
-# Add rules to new added SG
-def add_rule_to_new_SG():
-    boto3.setup_default_session(profile_name=account)
-    ec2 = boto3.client('ec2', dest_region)
+
+# Add ingress and egress rules of source SG to its copy, with one call per direction
+def add_rules_to_new_sg(group, id_map, prefix_map, created):
+    ec2 = get_client(dest_region)
+    new_sg_id = id_map[group['GroupId']]
     try:
-        for rule in get_sourceSG_rules():
-            if rule['IpProtocol'] == '-1':
-                for ip in rule['IpRanges']:
-                    try:
-                        ec2.authorize_security_group_ingress(GroupId=new_sg_id, IpProtocol='-1', CidrIp=ip['CidrIp'],
-                                                             FromPort=0, ToPort=65535)
-                    except Exception as e:
-                        print(e)
-            elif rule['IpProtocol'] == 'icmp':
-                for ip in rule['IpRanges']:
-                    try:
-                        ec2.authorize_security_group_ingress(GroupId=new_sg_id, IpProtocol='icmp', CidrIp=ip['CidrIp'],
-                                                             FromPort=-1, ToPort=-1)
-                    except Exception as e:
-                        print(e)
-            else:
-                for ip in rule['IpRanges']:
-                    try:
-                        ec2.authorize_security_group_ingress(GroupId=new_sg_id, IpProtocol=rule['IpProtocol'],
-                                                             CidrIp=ip['CidrIp'],
-                                                             FromPort=rule['FromPort'], ToPort=rule['ToPort'])
-                    except Exception as e:
-                        print(e)
+        ingress = [copy_rule(rule, id_map, prefix_map) for rule in group['IpPermissions']]
+        apply_rules(ec2.authorize_security_group_ingress, new_sg_id, [rule for rule in ingress if rule])
+
+        # New SG already has default egress rule, it is removed if source SG does not have it
+        egress_rules = group.get('IpPermissionsEgress', [])
+        egress = [copy_rule(rule, id_map, prefix_map, egress=True) for rule in egress_rules]
+        apply_rules(ec2.authorize_security_group_egress, new_sg_id, [rule for rule in egress if rule])
+        if created and not any(is_default_egress(rule) for rule in egress_rules):
+            apply_rules(ec2.revoke_security_group_egress, new_sg_id, [DEFAULT_EGRESS])
     except Exception as e:
         print(e)
 
 
-# Main
+# Main, all SGs are created first, so rules can reference copies of each other
 def main():
-    get_sourceSG_details()
-    create_new_sg()
-    add_rule_to_new_SG()
+    try:
+        with phase('describe_groups'):
+            groups = get_source_groups()
+            prefix_map = get_prefix_list_map(groups)
+        print('Moving {0} security groups from {1} to {2}'.format(len(groups), source_region, dest_region))
+
+        pool = ThreadPool(max(1, min(workers, len(groups))))
+        try:
+            with phase('create_groups'):
+                created_groups = pool.map(create_new_sg, groups)
+            id_map = dict((source_id, dest_id) for source_id, dest_id, _ in created_groups if dest_id is not None)
+            created = dict((source_id, is_created) for source_id, _, is_created in created_groups)
+            moved = [group for group in groups if group['GroupId'] in id_map]
+            count('groups', len(moved))
+            with phase('apply_rules'):
+                pool.map(lambda group: add_rules_to_new_sg(group, id_map, prefix_map, created[group['GroupId']]),
+                         moved)
+        finally:
+            pool.close()
+            pool.join()
+
+        for source_id, dest_id in sorted(id_map.items()):
+            print('{0} -> {1}'.format(source_id, dest_id))
+    finally:
+        write_trace()
 
 
 if __name__ == '__main__':